@@ -8,8 +8,16 @@ DOCBOOK_NAMESPACE = "xmlns='http://docbook.org/ns/docbook'"
 MFGAMES_NAMESPACE = "xmlns:mw='urn:mfgames:writing:docbook,0'"
 
 
-def get_file_hash(filename, block_size = 2**20):
-    """Retrieves the SHA-256 hash of the given filename."""
+def get_file_hash(filename, block_size = 2**20, cache = None):
+    """Retrieves the SHA-256 hash of the given filename.
+
+    If a cache (mfgames_writing.cache.FileHashCache) is given, then
+    the hash is only calculated if the file has changed since the last
+    time it was hashed.
+    """
+
+    if cache:
+        return cache.get_file_hash(filename)
     
     stream = open(filename, 'r')
     file_hash = hashlib.sha256()
@@ -0,0 +1,193 @@
+"""Handles the persistent caches used to avoid repeating work between
+runs of the tools."""
+
+
+import json
+import logging
+import mfgames_writing
+import os
+import tempfile
+import threading
+
+
+def get_cache_directory():
+    """Gets the directory the cache files are stored in, creating it
+    if it doesn't already exist."""
+
+    directory = os.environ.get('XDG_CACHE_HOME')
+
+    if not directory:
+        directory = os.path.join(os.path.expanduser('~'), '.cache')
+
+    directory = os.path.join(directory, 'mfgames-writing')
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    return directory
+
+
+def get_cache_filename(name):
+    """Gets the full path of a file inside the cache directory."""
+
+    return os.path.join(get_cache_directory(), name)
+
+
+def load_json(filename, default):
+    """Loads a JSON cache file, or returns the default if the file
+    doesn't exist or can't be read."""
+
+    try:
+        stream = open(filename, 'r')
+
+        try:
+            return json.load(stream)
+        finally:
+            stream.close()
+    except (IOError, ValueError):
+        return default
+
+
+def save_file(filename, contents):
+    """Saves the contents of a cache file, returning True if it was
+    written.
+
+    The contents are written to a unique temporary file first and then
+    renamed over the cache. This way, an interrupted run doesn't leave
+    a broken cache and runs that save the same cache at the same time
+    don't interfere with each other; the last one to finish wins. A
+    cache that can't be saved is only reported, since it will be built
+    again on the next run.
+    """
+
+    try:
+        handle, temp_filename = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(filename)),
+            prefix=os.path.basename(filename) + ".",
+            suffix=".tmp")
+    except (IOError, OSError) as e:
+        logging.getLogger('cache').warning(
+            "Cannot save cache " + filename + ": " + str(e))
+        return False
+
+    try:
+        stream = os.fdopen(handle, 'wb')
+
+        try:
+            stream.write(contents)
+        finally:
+            stream.close()
+
+        os.rename(temp_filename, filename)
+        return True
+    except (IOError, OSError) as e:
+        logging.getLogger('cache').warning(
+            "Cannot save cache " + filename + ": " + str(e))
+
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+        return False
+
+
+def save_json(filename, data):
+    """Saves a JSON cache file, returning True if it was written."""
+
+    return save_file(filename, json.dumps(data))
+
+
+class FileState(object):
+    """The size, modification time, and hash of a file, used to tell if
+    it changed since something was built from it.
+
+    An entry is a sequence of the size, modification time, and hash
+    from get_entry(). The file is unchanged if the size and time are
+    the same as the entry. Otherwise, the file is hashed and it is
+    still the same if the contents haven't changed, but the entry
+    needs to be recorded again with the new times.
+    """
+
+    def __init__(self, filename):
+        stat = os.stat(filename)
+        self.filename = filename
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.hash = None
+
+    def get_hash(self):
+        """Gets the hash of the file, only reading it the first time."""
+
+        if self.hash is None:
+            self.hash = mfgames_writing.get_file_hash(self.filename)
+
+        return self.hash
+
+    def get_entry(self):
+        """Gets the size, modification time, and hash to record."""
+
+        return [self.size, self.mtime, self.get_hash()]
+
+    def is_unchanged(self, entry):
+        """Determines if the size and modification time of the file
+        are the same as the entry, without reading the file."""
+
+        return bool(entry) and list(entry[:2]) == [self.size, self.mtime]
+
+    def is_same(self, entry):
+        """Determines if the file has the same contents as when the
+        entry was recorded, hashing the file if it was touched."""
+
+        if not entry:
+            return False
+
+        return self.is_unchanged(entry) or entry[2] == self.get_hash()
+
+
+class FileHashCache(object):
+    """Remembers the SHA-256 hash of files between runs.
+
+    Entries are keyed by the absolute path of the file and are only
+    used if the size, modification time, and inode of the file are
+    the same as when it was hashed. Any change to those causes the
+    file to be hashed again.
+    """
+
+    def __init__(self, filename=None):
+        if not filename:
+            filename = get_cache_filename('hashes.json')
+
+        self.filename = filename
+        self.hashes = load_json(filename, {})
+        self.changed = False
+        self.lock = threading.Lock()
+
+    def get_file_hash(self, filename):
+        """Retrieves the SHA-256 hash of the given filename, only
+        reading the file if it has changed."""
+
+        abs_filename = os.path.abspath(filename)
+        stat = os.stat(abs_filename)
+        key = [stat.st_size, stat.st_mtime, stat.st_ino]
+
+        with self.lock:
+            entry = self.hashes.get(abs_filename)
+
+        if entry and entry[:3] == key:
+            return entry[3]
+
+        # Either we haven't seen it or it changed, so hash it.
+        file_hash = mfgames_writing.get_file_hash(abs_filename)
+
+        with self.lock:
+            self.hashes[abs_filename] = key + [file_hash]
+            self.changed = True
+
+        return file_hash
+
+    def save(self):
+        """Writes out the cache if anything has changed."""
+
+        with self.lock:
+            if self.changed:
+                save_json(self.filename, self.hashes)
+                self.changed = False
@@ -0,0 +1,211 @@
+"""Handles the different XML parsing backends used by the scanners.
+
+The scanners are written as SAX content handlers. The SAX backend
+calls back into Python for every element and chunk of text, which is
+slow on large books. The lxml backend uses iterparse to only report
+the elements a scanner asks for, passing the text of an element in a
+single call when it ends, and clears out elements as it goes so the
+memory stays bounded.
+
+Scanners that only look at attributes can also use the fast backend,
+which skips files that can't have the elements and otherwise only
+reports the start of the elements, without any text.
+
+The lxml and fast backends need every namespace prefix to be declared,
+which SAX doesn't check, so SAX is always the default.
+"""
+
+
+import lxml.etree
+import xml.sax
+
+
+def add_parser_argument(parser, fast=False):
+    """Adds the argument for choosing the parsing backend. If fast is
+    set, then the scanner only needs the start of elements and the
+    fast backend is also offered."""
+
+    choices = ['sax', 'lxml']
+    help = ("Determines how the XML is parsed. 'lxml' is faster on large "
+        + "files but only reports the elements that are needed and "
+        + "requires namespace prefixes to be declared.")
+
+    if fast:
+        choices.append('fast')
+        help += (" 'fast' only reports the start of those elements and "
+            + "doesn't check files that don't mention them at all.")
+
+    parser.add_argument(
+        '--parser',
+        default='sax',
+        choices=choices,
+        help=help)
+
+
+def get_local_name(element):
+    """Gets the name of an lxml element without its namespace."""
+
+    # Elements with an undeclared prefix keep it as part of the tag
+    # (e.g., xinclude:include), which isn't a valid qualified name.
+    try:
+        return lxml.etree.QName(element).localname
+    except ValueError:
+        return element.tag.split(":")[-1]
+
+
+def get_name(element):
+    """Gets the SAX-style name of an lxml element, including the
+    prefix if it has one (e.g., xinclude:include)."""
+
+    # An undeclared prefix is already part of the tag.
+    if ":" in element.tag and not element.tag.startswith("{"):
+        return element.tag
+
+    name = get_local_name(element)
+
+    if element.prefix:
+        name = element.prefix + ":" + name
+
+    return name
+
+
+def get_text(element):
+    """Gets all of the text inside an element, including the text of
+    its children but not its own tail."""
+
+    return u''.join(element.itertext())
+
+
+def iterparse(filename, names, text_names=()):
+    """Goes through the elements in the file with the given local
+    names, reporting the start and end of each one.
+
+    Once an element has ended, it is cleared along with the siblings
+    before it. Elements in text_names are never cleared while they
+    are open, since their text is read when they end.
+    """
+
+    tags = ['{*}' + name for name in names]
+    open_text = 0
+
+    for event, element in lxml.etree.iterparse(
+        filename,
+        events=('start', 'end'),
+        tag=tags,
+        resolve_entities=False):
+        # Keep track of how many text elements we are inside.
+        is_text = get_local_name(element) in text_names
+
+        if is_text:
+            if event == 'start':
+                open_text += 1
+            else:
+                open_text -= 1
+
+        yield event, element
+
+        # Clear out anything we've finished with.
+        if event == 'end' and open_text == 0:
+            element.clear()
+
+            # The root element has no parent, but a comment or
+            # processing instruction before it is still a sibling.
+            parent = element.getparent()
+
+            if parent is not None:
+                while element.getprevious() is not None:
+                    del parent[0]
+
+
+def contains_any(filename, names, block_size=2**20):
+    """Determines if any of the names appear anywhere in the file. The
+    file is read in blocks, keeping enough of the end of the previous
+    block to find names that cross between them."""
+
+    overlap = max([len(name) for name in names]) - 1
+    stream = open(filename, 'rb')
+
+    try:
+        data = ''
+
+        while True:
+            block = stream.read(block_size)
+
+            if not block:
+                return False
+
+            data = data[-overlap:] + block if overlap else block
+
+            for name in names:
+                if name in data:
+                    return True
+    finally:
+        stream.close()
+
+
+def scan_start_elements(handler, filename, names):
+    """Reports the start of the elements with the given local names
+    to the handler, without any text or the end of the elements.
+
+    The file is checked for the names before it is parsed. If none of
+    them appear anywhere in the file, then it isn't parsed at all,
+    which means it also isn't checked for being well-formed. If lxml
+    can't parse the file (e.g., a prefix isn't declared), then the
+    SAX parser is used for that file instead.
+    """
+
+    if not contains_any(filename, names):
+        return
+
+    # Collect the elements before reporting them, so nothing has been
+    # reported if we have to use the SAX parser.
+    starts = []
+
+    try:
+        for event, element in iterparse(filename, names):
+            if event == 'start':
+                starts.append((get_name(element), dict(element.attrib)))
+    except lxml.etree.XMLSyntaxError:
+        parse(handler, filename, 'sax', names)
+        return
+
+    for name, attrs in starts:
+        handler.startElement(name, attrs)
+
+
+def parse(handler, filename, backend, names, text_names=()):
+    """Parses the file using the given content handler.
+
+    With the SAX backend, the handler sees everything in the file.
+    With lxml, it only sees the elements in names and gets the entire
+    text of an element in text_names with one call to characters()
+    right before that element ends. With the fast backend, it only
+    sees the start of the elements in names.
+    """
+
+    if backend == 'fast':
+        scan_start_elements(handler, filename, names)
+        return
+
+    # The SAX parser is the original implementation.
+    if backend == 'sax':
+        parser = xml.sax.make_parser()
+        parser.setFeature(
+            "http://xml.org/sax/features/external-general-entities",
+            False)
+        parser.setContentHandler(handler)
+        parser.parse(filename)
+        return
+
+    # Otherwise, drive the handler from lxml.
+    for event, element in iterparse(filename, names, text_names):
+        name = get_name(element)
+
+        if event == 'start':
+            handler.startElement(name, element.attrib)
+            continue
+
+        if get_local_name(element) in text_names:
+            handler.characters(get_text(element))
+
+        handler.endElement(name)
@@ -3,33 +3,201 @@ producing output based on its contents."""
 
 
 import mfgames_tools.process
+import mfgames_writing.docbook.backend
 import mfgames_writing.docbook.scan
 import mfgames_writing.format
 import os
+import re
 import sys
 import xml
 
 
+# The rule-based sentence detection. A sentence ends with a word that
+# has terminal punctuation, optionally followed by closing quotes or
+# brackets, unless that word is a common abbreviation or an initial.
+# Both expressions require whitespace after the match so they only
+# see complete words. "I." is left out of the initials on purpose.
+_SENTENCE_END = re.compile(
+    u'[.!?\u2026]+[\'"\u2019\u201d)\\]]*(?=\\s)',
+    re.UNICODE)
+_SENTENCE_ABBREVIATION = re.compile(
+    u'(?<!\\S)(?:Mr|Mrs|Ms|Dr|St|Jr|Sr|Prof|Rev|[A-HJ-Z])\\.(?=\\s)',
+    re.UNICODE)
+
+
+# The columns that can be counted, in the same order as the counts.
+_COLUMNS = ['paragraphs', 'words', 'sentences', 'characters', 'nonspace']
+
+
+def get_column_name(format):
+    """Normalizes a column name given on the command line.
+
+    Columns may be abbreviated to their first letter, with "ch" and
+    "co" needed to tell characters from context.
+    """
+
+    format = format.strip().lower()
+
+    if format.startswith('ch'):
+        return 'characters'
+
+    if format.startswith('c'):
+        return 'context'
+
+    for column in _COLUMNS:
+        if format and column.startswith(format[0]):
+            return column
+
+    raise Exception("Unknown count column: " + format)
+
+
+def add_record(total, record):
+    """Adds the counts in a record into the total record."""
+
+    for index in range(len(record)):
+        total[index] += record[index]
+
+
 class _CountScanner(xml.sax.ContentHandler):
     """Parses the DocBook XML and counts the various elements."""
 
-    def __init__(self, process):
+    def __init__(self, process, filename):
         xml.sax.ContentHandler.__init__(self)
 
         self.process = process
+        self.input_directory = os.path.dirname(os.path.abspath(filename))
         self.buffer = None
-        self.gather_buffer = False
-        self.context = None
+        self.gather_title = False
         self.need_chapter_title = False
 
+        # The counts are gathered into segments instead of directly
+        # into the process so the results of a file can be reused
+        # when it is included more than once. Each segment is a list
+        # of whether it is a chapter, the chapter title, and the
+        # record of counts. Outside of a chapter, we use a segment
+        # that isn't a chapter.
+        self.segments = []
+        self.add_segment(False)
+
+        # Sentences are the only count that is noticeably more
+        # expensive, so only look for them if they are requested.
+        self.count_sentences = "sentences" in process.args.columns
+        self.reset_count()
+        self.gather_buffer = False
+
     def characters(self, contents):
         """Processes character from the XML stream."""
 
-        # If we are gathering characters into the buffer, then append
-        # the contents.
+        # If we are counting, then add the words from this chunk
+        # without holding on to the text itself.
         if self.gather_buffer:
+            self.count_words(contents)
+
+        # Titles may become the chapter name, so we have to keep those
+        # around. They are short enough that it doesn't matter.
+        if self.gather_title:
             self.buffer += contents
 
+    def count_words(self, contents):
+        """Counts the words, characters, and sentences in the given
+        chunk of text.
+
+        SAX can break a single word across multiple calls, so we keep
+        track of whether the last chunk ended in the middle of a word
+        and don't count the rest of it a second time. This gives the
+        same count as splitting the entire paragraph on whitespace.
+        """
+
+        if not contents:
+            return
+
+        # Passing None into this will cause it to split on any
+        # whitespace, the same as isspace() checks below.
+        split = contents.split(None)
+        words = len(split)
+
+        if words > 0 and self.in_word and not contents[0].isspace():
+            words -= 1
+
+        self.word_count += words
+        self.nonspace_count += sum(map(len, split))
+
+        # For sentences, we prepend the partial word from the last
+        # chunk so the expressions see the entire word.
+        if self.count_sentences:
+            text = self.partial_word + contents
+            self.sentence_count += (
+                len(_SENTENCE_END.findall(text))
+                - len(_SENTENCE_ABBREVIATION.findall(text)))
+
+            if contents[-1].isspace():
+                self.partial_word = u''
+                text = text.rstrip()
+
+                if text:
+                    self.last_word = text.rsplit(None, 1)[-1]
+            else:
+                self.partial_word = text.rsplit(None, 1)[-1][-64:]
+
+        self.in_word = not contents[-1].isspace()
+
+    def reset_count(self):
+        """Starts counting a new paragraph or title."""
+
+        self.gather_buffer = True
+        self.word_count = 0
+        self.nonspace_count = 0
+        self.sentence_count = 0
+        self.in_word = False
+        self.partial_word = u''
+        self.last_word = u''
+        self.record = None
+
+    def finish_count(self):
+        """Finishes counting the current paragraph or title and
+        returns the record of counts for it.
+
+        The record is in the same order as the process's counts:
+        paragraph, word, sentence, character, and non-space
+        character. Characters are counted with the whitespace
+        collapsed into a single space between words.
+        """
+
+        # Nested paragraphs can finish more than once, so we keep the
+        # first results.
+        if not self.gather_buffer:
+            return self.record
+
+        self.gather_buffer = False
+
+        # Finish up the last sentence. A trailing partial word is
+        # complete now, and a paragraph that doesn't end with terminal
+        # punctuation still has one more sentence in it.
+        if self.count_sentences and self.word_count > 0:
+            if self.partial_word:
+                self.count_words(u' ')
+
+            last_word = self.last_word + u' '
+            ends_sentence = (
+                len(_SENTENCE_END.findall(last_word))
+                > len(_SENTENCE_ABBREVIATION.findall(last_word)))
+
+            if not ends_sentence:
+                self.sentence_count += 1
+
+        characters = self.nonspace_count
+
+        if self.word_count > 0:
+            characters += self.word_count - 1
+
+        self.record = [
+            1,
+            self.word_count,
+            self.sentence_count,
+            characters,
+            self.nonspace_count]
+        return self.record
+
     def startElement(self, name, attrs):
         """Processes the beginning of the XML element."""
 
@@ -37,93 +205,82 @@ class _CountScanner(xml.sax.ContentHandler):
         # into a buffer so we can process it.
         if name == "para" or name == "simpara":
             self.need_chapter_title = False
-            self.gather_buffer = True
-            self.buffer = ""
+            self.reset_count()
 
         if name == "title":
-            self.gather_buffer = True
+            self.reset_count()
+            self.gather_title = self.need_chapter_title
             self.buffer = ""
 
         if name == "chapter":
             self.set_chapter()
-            
+
+        # If we are following includes, then count the included file
+        # as if it was part of this one.
+        if name == "xinclude:include" and self.process.args.follow_xincludes:
+            href = attrs["href"]
+            include_filename = os.path.abspath(
+                os.path.join(self.input_directory, href))
+            self.add_segments(self.process.count_file(include_filename))
 
     def endElement(self, name):
         """Processes the end of the XML element."""
 
-        # If we are at the end of the chapter, then clear the context
-        # if we are chapter-based.
+        # If we are at the end of the chapter, then start a new
+        # segment for everything outside of the chapter.
         if name == "chapter" and self.process.args.context == 'chapters':
-            self.context = None
+            self.add_segment(False)
 
         # If we are at the end of a title, see if we think this is the
         # chapter title.
         if name == "title":
-            self.gather_buffer = False
+            self.gather_title = False
 
             if self.need_chapter_title:
                 # We don't need the chapter title anymore
                 self.need_chapter_title = False
 
-                # Grab the current chapter name
-                current_title = self.process.order[len(self.process.order) - 1]
-
-                # Change both the counts and the order.
-                self.process.counts[self.buffer] = (
-                    self.process.counts[current_title])
-
-                del self.process.counts[current_title]
-                self.process.order[len(self.process.order) - 1] = self.buffer
-
-                # Change the context for saving values.
-                self.context = self.buffer
+                # Name the current chapter segment.
+                self.segment[1] = self.buffer
 
         # At the end of each para or simppara tag, we increment the
-        # paragraph counter and also process the collected buffer.
+        # paragraph counter and also process the collected counts.
         if name == "para" or name == "simpara" or name == "title":
-            # Indicate we are done gathering characters into the buffer.
-            self.gather_buffer = False
+            # Add the counts we built up while streaming.
+            add_record(self.segment[2], self.finish_count())
 
-            # Gather up the word count from the buffer. Passing None
-            # into this will cause it to split on any whitespace.
-            para_word_count = len(self.buffer.split(None))
+    def add_segment(self, is_chapter):
+        """Starts a new segment of counts."""
 
-            # If we don't have a context, we don't do anything remarkable.
-            if self.context:        
-                # Add the counts into the totals.
-                self.process.counts["_total"][0] += 1
-                self.process.counts["_total"][1] += para_word_count
+        self.segment = [is_chapter, None, [0, 0, 0, 0, 0]]
+        self.segments.append(self.segment)
 
-                # Add the counts to the context, if we have one.
-                self.process.counts[self.context][0] += 1
-                self.process.counts[self.context][1] += para_word_count
+    def add_segments(self, segments):
+        """Adds the segments from an included file into this one.
 
-    def set_chapter(self):
-        """Sets the chapter as the context depending on the process
-        options."""
+        The first segment of a file is the text before any chapter,
+        so it is part of whatever segment we are currently in. The
+        rest are either chapters or the text after them.
+        """
 
-        if self.process.args.context != 'chapters':
-            return
+        for index in range(len(segments)):
+            is_chapter, title, record = segments[index]
 
-        self.context = 'Chapter ' + format(len(self.process.order) + 1)
-        self.need_chapter_title = True
+            if index > 0:
+                self.add_segment(is_chapter)
+                self.segment[1] = title
 
-        if not self.context in self.process.counts:
-            self.process.counts[self.context] = [0, 0]
-            self.process.order.append(self.context)
+            add_record(self.segment[2], record)
 
-    def set_filename(self, filename):
-        """Sets the filename as the context depending on the process
+    def set_chapter(self):
+        """Starts a chapter segment depending on the process
         options."""
 
-        if self.process.args.context != 'files':
+        if self.process.args.context != 'chapters':
             return
 
-        self.context = filename
-
-        if not filename in self.process.counts:
-            self.process.counts[filename] = [0, 0]
-            self.process.order.append(filename)
+        self.add_segment(True)
+        self.need_chapter_title = True
 
 
 class CountProcess(mfgames_tools.process.InputFilesProcess):
@@ -140,17 +297,24 @@ class CountProcess(mfgames_tools.process.InputFilesProcess):
         # The counts is the critical part of this class. It is a
         # dictionary with the textual context as the key and an array
         # of numbers. The array consists of the counts in this order:
-        # paragraph, word.
+        # paragraph, word, sentence, character, non-space character.
         self.counts = {
-            "_title": ["Paragraphs", "Words"],
-            "_average": [0, 0],
-            "_total": [0, 0]
+            "_title": [
+                "Paragraphs", "Words", "Sentences", "Characters",
+                "Non-Space"],
+            "_average": [0, 0, 0, 0, 0],
+            "_total": [0, 0, 0, 0, 0]
             }
 
         # Keep track of the order scanned so we can order the output
         # appropriately.
         self.order = []
 
+        # The segments for every file we've counted, keyed by the
+        # absolute path. This lets us only parse a file once, even if
+        # it is included from multiple places.
+        self.files = {}
+
     def get_columns(self, key, value):
         """Gets and orders the columns for the output based on the
         given line (context) item."""
@@ -161,12 +325,10 @@ class CountProcess(mfgames_tools.process.InputFilesProcess):
 
         # Go through the columns and add a column for each request.
         for format in self.args.columns:
-            if format.lower().startswith('w'):
-                results.append(record[1])
-            if format.lower().startswith('p'):
-                results.append(record[0])
-            if format.lower().startswith('c'):
+            if format == 'context':
                 results.append(value)
+            else:
+                results.append(record[_COLUMNS.index(format)])
 
         # Return the resulting table.
         return results
@@ -187,7 +349,7 @@ class CountProcess(mfgames_tools.process.InputFilesProcess):
         if args.columns:
             for format in args.columns:
                 for format_element in format.split(','):
-                    columns.append(format_element)
+                    columns.append(get_column_name(format_element))
 
         # If we don't have a defined format, then check to see if the
         # preset ones are requested.
@@ -238,8 +400,10 @@ class CountProcess(mfgames_tools.process.InputFilesProcess):
             count = len(self.order)
 
             if count > 0:
-                self.counts["_average"][0] = int(self.counts["_total"][0] / count)
-                self.counts["_average"][1] = int(self.counts["_total"][1] / count)
+                for index in range(len(_COLUMNS)):
+                    self.counts["_average"][index] = int(
+                        self.counts["_total"][index] / count)
+
                 table.append(self.get_columns("_average", "Average"))
 
         # Fourth, add the total column, if the arguments require it.
@@ -249,25 +413,78 @@ class CountProcess(mfgames_tools.process.InputFilesProcess):
         # Format and output the table to the standard out.
         mfgames_writing.format.output_table(sys.stdout, table, args.format)
 
+    def add_context(self, context, record):
+        """Adds the record of counts to the given context and the
+        total."""
+
+        if not context in self.counts:
+            self.counts[context] = [0, 0, 0, 0, 0]
+            self.order.append(context)
+
+        add_record(self.counts[context], record)
+        add_record(self.counts["_total"], record)
+
+    def count_file(self, filename):
+        """Counts a single file and returns the resulting segments.
+
+        The results are kept so a file that is included more than
+        once is only parsed the first time.
+        """
+
+        abs_filename = os.path.abspath(filename)
+
+        if abs_filename in self.files:
+            segments = self.files[abs_filename]
+
+            if segments is None:
+                raise Exception(
+                    "Cannot count recursively included file: " + filename)
+
+            return segments
+
+        # Mark that we are in the middle of this file, so we can catch
+        # files that include themselves.
+        self.files[abs_filename] = None
+
+        # Open up the input file as XML and parse through the
+        # contents. This will use the arguments to determine how to
+        # break up the counts into segments.
+        scanner = _CountScanner(self, filename)
+        mfgames_writing.docbook.backend.parse(
+            scanner,
+            filename,
+            self.args.parser,
+            ["chapter", "include", "para", "simpara", "title"],
+            ["para", "simpara", "title"])
+
+        self.files[abs_filename] = scanner.segments
+        return scanner.segments
+
     def process_filename(self, filename):
         """Processes a single file and counts the appropriate
         elements."""
 
-        # Set up the scanner and, optionally, the context as the file
-        # being scanned.
-        scanner = _CountScanner(self)
-        scanner.set_filename(filename)
+        segments = self.count_file(filename)
 
-        # Open up the input file as XML and parse through the
-        # contents. This will use the arguments to determine how to
-        # break up the counts and produce a dictionary of the various
-        # counts.
-        parser = xml.sax.make_parser()
-        parser.setFeature(
-            "http://xml.org/sax/features/external-general-entities",
-            False)
-        parser.setContentHandler(scanner)
-        parser.parse(open(filename))
+        # If we are counting by files, then everything in the file
+        # goes into the one context.
+        if self.args.context == 'files':
+            for is_chapter, title, record in segments:
+                self.add_context(filename, record)
+
+            return
+
+        # Otherwise, each chapter is the context and we ignore
+        # everything outside of them. Chapters without a title are
+        # numbered by their position.
+        for is_chapter, title, record in segments:
+            if not is_chapter:
+                continue
+
+            if not title:
+                title = 'Chapter ' + format(len(self.order) + 1)
+
+            self.add_context(title, record)
 
     def setup_arguments(self, parser):
         """Sets up the command-line arguments for file processing."""
@@ -298,6 +515,13 @@ class CountProcess(mfgames_tools.process.InputFilesProcess):
             '-f',
             default=False,
             action='store_true')
+        mfgames_writing.docbook.backend.add_parser_argument(parser)
+        parser.add_argument(
+            '--follow-xincludes',
+            default=False,
+            action='store_true',
+            help="If set, then files included with xinclude:include are "
+                + "counted as part of the file that includes them.")
 
         parser.add_argument(
             '--words',
@@ -314,6 +538,9 @@ class CountProcess(mfgames_tools.process.InputFilesProcess):
         parser.add_argument(
             '--columns',
             '-c',
-            default=False,
-            action='store_true',
-            help="Include the paragraph count column.")
+            default=None,
+            type=str,
+            action='append',
+            help="A comma-separated list of columns to include: "
+                + "paragraphs, words, sentences, characters, nonspace "
+                + "(characters without whitespace), and context.")
@@ -1,22 +1,60 @@
 import logging
 import mfgames_tools.process
+import mfgames_writing.cache
+import mfgames_writing.docbook.backend
+import mfgames_writing.docbook.media
 import xml.sax
 import xml.sax.saxutils
 import os
 
 
+def escape_ninja(path):
+    """Escapes a path for use in a ninja build file."""
+
+    return path.replace('$', '$$').replace(' ', '$ ').replace(':', '$:')
+
+
 class _DependsScanner(xml.sax.ContentHandler):
-    def __init__(self, args, filename):
+    """Collects the references to other files exactly as they are
+    written in the file. These only depend on the contents of the
+    file, so they can be cached between runs."""
+
+    def __init__(self):
         # Initialize the class.
         xml.sax.ContentHandler.__init__(self)
 
+        # Gather up all the references into a variable.
+        self.references = []
+
+    def startElement(self, name, attrs):
+        if name == "xinclude:include":
+            self.references.append(["include", attrs["href"]])
+
+        if name == "imagedata":
+            self.references.append(["image", attrs["fileref"]])
+
+
+class _DependsReporter(object):
+    """Turns the references in a file into the paths reported to the
+    user."""
+
+    def __init__(self, args, filename, base_directory):
         # Save the simple variables in the class.
         self.filename = filename
         self.args = args
 
+        # Paths are reported relative to the directory of the first
+        # file, which is different when we are scanning included files.
+        self.input_directory = os.path.dirname(os.path.abspath(filename))
+        self.base_directory = base_directory
+
         # Gather up all the names into a variable.
         self.depends = []
 
+        # Keep track of the absolute paths of the included files so
+        # we can scan them when we are recursive.
+        self.includes = []
+
         # Get the input file with the appropriate relative root.
         self.rel_filename = filename
 
@@ -30,27 +68,57 @@ class _DependsScanner(xml.sax.ContentHandler):
                 args.directory_prefix,
                 self.rel_filename)
 
-    def startElement(self, name, attrs):
-        if name == "xinclude:include" and not self.args.no_xinclude:
-            href = attrs["href"]
+    def add_references(self, references):
+        """Adds the references found by the scanner."""
+
+        for kind, path in references:
+            if kind == "include":
+                self.add_include(path)
+            else:
+                self.add_image(path)
+
+    def add_include(self, href):
+        self.includes.append(
+            os.path.abspath(os.path.join(self.input_directory, href)))
+
+        if not self.args.no_xinclude:
             self.report(href)
 
-        if name == "imagedata" and not self.args.no_images:
-            fileref = attrs["fileref"]
-            self.report(fileref)
+    def add_image(self, fileref):
+        if self.args.no_images:
+            return
+
+        # If we are searching for media, then report where the file
+        # was actually found.
+        if self.args.media_index:
+            relative_dirname = os.path.relpath(
+                self.input_directory,
+                self.base_directory)
+            abs_fileref = self.args.media_index.find(
+                os.path.join(relative_dirname, fileref),
+                self.args.warn_ambiguous_media)
+
+            if abs_fileref:
+                fileref = os.path.relpath(
+                    abs_fileref,
+                    self.input_directory)
+
+        self.report(fileref)
 
     def report(self, path):
         """Reports the path to the user."""
 
+        # Figure out what the absolute path of the included file would be.
+        abs_path = os.path.join(self.input_directory, path)
+
         # If we have a relative root, we want to show the full path.
         if self.args.directory_root:
-            # Figure out what the absolute path of the included file would be.
-            root_path = os.path.abspath(self.filename)
-            root_directory = os.path.dirname(root_path)
-            abs_path = os.path.join(root_directory, path)
-
             # Remove the root from this and set the path to that relative root.
             path = os.path.relpath(abs_path, self.args.directory_root)
+        elif self.input_directory != self.base_directory:
+            # This is an included file in a different directory, so
+            # make it relative to the first file.
+            path = os.path.relpath(abs_path, self.base_directory)
 
         # Figure out if we need a directory prefix.
         if self.args.directory_prefix:
@@ -60,41 +128,225 @@ class _DependsScanner(xml.sax.ContentHandler):
         self.depends.append(path)
 
 
-class DependsFileProcess(mfgames_tools.process.InputFileProcess):
+class _DependsCache(object):
+    """Remembers the references in each file between runs.
+
+    An entry is used as-is if the size and modification time of the
+    file haven't changed. If they have, then the file is hashed and
+    the entry is still used if the contents are the same. Only files
+    that have actually changed are parsed again.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = mfgames_writing.cache.load_json(filename, {})
+        self.changed = False
+
+    def get_references(self, filename, scan):
+        """Gets the references in the file, calling scan with the
+        filename if they aren't in the cache."""
+
+        abs_filename = os.path.abspath(filename)
+        state = mfgames_writing.cache.FileState(abs_filename)
+        entry = self.entries.get(abs_filename)
+
+        if state.is_unchanged(entry):
+            return entry[3]
+
+        if state.is_same(entry):
+            references = entry[3]
+        else:
+            references = scan(abs_filename)
+
+        self.entries[abs_filename] = state.get_entry() + [references]
+        self.changed = True
+        return references
+
+    def save(self):
+        """Writes out the cache if anything has changed."""
+
+        if self.changed:
+            mfgames_writing.cache.save_json(self.filename, self.entries)
+            self.changed = False
+
+
+def get_ninja_target(template, rel_filename):
+    """Gets the output of the build edge for an input file. The
+    template may use {input} for the input file and {stem} for the
+    input file without its extension."""
+
+    return template.format(
+        input=rel_filename,
+        stem=os.path.splitext(rel_filename)[0])
+
+
+class DependsFileProcess(mfgames_tools.process.InputFilesProcess):
     def __init__(self):
         super(DependsFileProcess, self).__init__()
 
     def process(self, args):
-        # Handle the base class' processing which verifies the file
-        # already exists.
-        super(DependsFileProcess, self).process(args)
-
-        # The gather process is somewhat verbose so we'll use a logger.
-        log = logging.getLogger('depends')
-        
-        # Create the parser with the output file and the current path.
-        scanner = _DependsScanner(args, args.file)
-        parser = xml.sax.make_parser()
-        parser.setFeature(
-            "http://xml.org/sax/features/external-general-entities",
-            False)
-        parser.setContentHandler(scanner)
-        parser.parse(args.file)
+        # A ninja dyndep file has to name the output of the build edge,
+        # which we can't guess, and each input needs its own output.
+        if args.format == 'ninja':
+            if not args.ninja_target:
+                raise Exception(
+                    "The ninja format requires --ninja-target to name "
+                    + "the output of the build edge.")
+
+            if (len(args.files) > 1
+                and get_ninja_target(args.ninja_target, "a")
+                    == get_ninja_target(args.ninja_target, "b")):
+                raise Exception(
+                    "With more than one input file, --ninja-target must "
+                    + "use {input} or {stem} so each file has its own "
+                    + "output.")
+
+        # If we have media search directories, index them so we can
+        # report where the images are found. This is done once for
+        # all of the files.
+        args.media_index = None
+
+        if args.media_search:
+            args.media_index = mfgames_writing.docbook.media.MediaIndex(
+                args.media_search)
+
+        # Load up the references from the previous runs.
+        args.depends_cache = None
+
+        if args.depends_cache_file:
+            args.depends_cache = _DependsCache(args.depends_cache_file)
+
+        # Handle the base class' processing which verifies the files
+        # already exist and calls process_file for each one.
+        self.shown_ninja_version = False
+
+        try:
+            super(DependsFileProcess, self).process(args)
+        finally:
+            if args.depends_cache:
+                args.depends_cache.save()
+
+    def process_file(self, filename):
+        # Scan the file and, if we are recursive, everything it
+        # includes. The visited set makes sure we only scan each file
+        # once, even if it is included from multiple places.
+        args = self.args
+        base_directory = os.path.dirname(os.path.abspath(filename))
+        reporter = self.scan_file(filename, base_directory)
+        depends = reporter.depends
+
+        if args.recursive:
+            visited = set([os.path.abspath(filename)])
+            depends = []
+            self.add_depends(depends, reporter, base_directory, visited)
 
         # Once we are done, figure out how to format it.
-        depends = scanner.depends
+        lines = []
 
         if self.args.format == 'list':
-            print "\n".join(depends)
+            lines.extend(depends)
 
         if self.args.format == "makefile":
-            filename = scanner.rel_filename
+            target = reporter.rel_filename
 
             if args.makefile_prefix:
-                filename += " {0}".format(args.makefile_prefix)
+                target += " {0}".format(args.makefile_prefix)
+
+            lines.append("{0}: {1}".format(target, " ".join(depends)))
+
+        if self.args.format == "ninja":
+            target = get_ninja_target(args.ninja_target, reporter.rel_filename)
+            lines.append("build {0}: dyndep | {1}".format(
+                escape_ninja(target),
+                " ".join([escape_ninja(path) for path in depends])))
+
+        # A ninja dyndep file can only have one version line, so it is
+        # shown once before the first file and put in every file we
+        # write out.
+        if self.args.format == "ninja":
+            if args.write_depends or not self.shown_ninja_version:
+                lines.insert(0, "ninja_dyndep_version = 1")
+                self.shown_ninja_version = True
+
+        # If we aren't writing out dependency files, then just show it.
+        if not args.write_depends:
+            for line in lines:
+                print line
+            return
+
+        self.write_depends(filename + args.depends_extension, lines)
+
+    def write_depends(self, filename, lines):
+        """Writes out the dependency file, but only if it changed so
+        the build doesn't see a newer file for nothing."""
+
+        contents = u"".join([line + u"\n" for line in lines])
+        contents = contents.encode('utf-8')
+
+        if os.path.isfile(filename):
+            stream = open(filename, 'rb')
+
+            try:
+                if stream.read() == contents:
+                    return
+            finally:
+                stream.close()
+
+        stream = open(filename, 'wb')
+
+        try:
+            stream.write(contents)
+        finally:
+            stream.close()
+
+        logging.getLogger('depends').info("Wrote dependency file: " + filename)
 
-            print "{0}: {1}".format(filename, " ".join(depends))
+    def add_depends(self, depends, reporter, base_directory, visited):
+        """Adds the dependencies of the reporter to the list, then
+        recursively scans the files it includes."""
 
+        for path in reporter.depends:
+            if path not in depends:
+                depends.append(path)
+
+        for include_filename in reporter.includes:
+            if include_filename in visited:
+                continue
+
+            visited.add(include_filename)
+
+            if not os.path.isfile(include_filename):
+                logging.getLogger('depends').warning(
+                    "Cannot find included file: " + include_filename)
+                continue
+
+            include_reporter = self.scan_file(include_filename, base_directory)
+            self.add_depends(depends, include_reporter, base_directory, visited)
+
+    def scan_file(self, filename, base_directory):
+        """Scans a single file for its dependencies."""
+
+        if self.args.depends_cache:
+            references = self.args.depends_cache.get_references(
+                filename,
+                self.scan_references)
+        else:
+            references = self.scan_references(filename)
+
+        reporter = _DependsReporter(self.args, filename, base_directory)
+        reporter.add_references(references)
+        return reporter
+
+    def scan_references(self, filename):
+        """Parses the file to find the references to other files."""
+
+        scanner = _DependsScanner()
+        mfgames_writing.docbook.backend.parse(
+            scanner,
+            filename,
+            self.args.parser,
+            ["include", "imagedata"])
+        return scanner.references
 
     def setup_arguments(self, parser):
         # Add in the argument from the base class.
@@ -108,11 +360,25 @@ class DependsFileProcess(mfgames_tools.process.InputFileProcess):
             default=None)
         parser.add_argument(
             '--format', '-f',
-            choices=['list', 'makefile'],
+            choices=['list', 'makefile', 'ninja'],
             default='list')
         parser.add_argument(
             '--makefile-prefix',
             default=None)
+        parser.add_argument(
+            '--ninja-target',
+            default=None,
+            help="The output of the build edge for the ninja dyndep file, "
+                + "required for the ninja format. {input} is replaced with "
+                + "the input file and {stem} with the input file without "
+                + "its extension (e.g., '{stem}.html').")
+        parser.add_argument(
+            '--recursive', '-r',
+            default=False,
+            action="store_true",
+            help="If set, then included files are also scanned and all "
+                + "of their dependencies are listed.")
+        mfgames_writing.docbook.backend.add_parser_argument(parser, True)
 
         parser.add_argument(
             '--no-xinclude', '-x',
@@ -122,6 +388,40 @@ class DependsFileProcess(mfgames_tools.process.InputFileProcess):
             '--no-images', '-i',
             default=False,
             action="store_true")
+        parser.add_argument(
+            '--media-search', '-M',
+            metavar='DIR',
+            type=str,
+            nargs="+",
+            help="Lists the directories that will be searched for media "
+                + "files. If set, then images are reported where they "
+                + "are found instead of how they are referenced.")
+        parser.add_argument(
+            '--warn-ambiguous-media',
+            default=False,
+            action='store_true',
+            help="If set, then a warning is given when a media file is "
+                + "found in more than one of the search directories.")
+        parser.add_argument(
+            '--write-depends', '-w',
+            default=False,
+            action='store_true',
+            help="If set, then the dependencies of each input file are "
+                + "written to a file next to it instead of being shown.")
+        parser.add_argument(
+            '--depends-extension',
+            default='.d',
+            help="The extension added to the input file when writing "
+                + "the dependency files.")
+        parser.add_argument(
+            '--depends-cache',
+            dest='depends_cache_file',
+            metavar='FILE',
+            type=str,
+            help="If set, then the references in each file are remembered "
+                + "in this file between runs. Every run rewrites the whole "
+                + "file, so builds that run in parallel should each use "
+                + "their own (e.g., one in each build directory).")
 
     def get_help(self):
         return "Lists all the depends files."
@@ -3,17 +3,68 @@ and adjustment of paths and resources while copying them into a single
 directory."""
 
 
-import codecs
 import logging
 import mfgames_tools.process
 import mfgames_writing
+import mfgames_writing.cache
+import mfgames_writing.docbook.backend
+import mfgames_writing.docbook.depends
+import mfgames_writing.docbook.media
+import mfgames_writing.stream
 import os
-import shutil
 import sys
 import xml.sax
 import xml.sax.saxutils
 
 
+def _count_includes(filename):
+    """Counts how many times each file is included, starting with the
+    given file. Each file is only looked at once, and only the start
+    of the include elements is parsed."""
+
+    counts = {}
+    pending = [os.path.abspath(filename)]
+    scanned = set(pending)
+
+    while pending:
+        current = pending.pop()
+        scanner = mfgames_writing.docbook.depends._DependsScanner()
+        mfgames_writing.docbook.backend.parse(
+            scanner,
+            current,
+            'fast',
+            ["include"])
+
+        for kind, href in scanner.references:
+            include_filename = os.path.abspath(
+                os.path.join(os.path.dirname(current), href))
+            counts[include_filename] = counts.get(include_filename, 0) + 1
+
+            if (include_filename not in scanned
+                and os.path.isfile(include_filename)):
+                scanned.add(include_filename)
+                pending.append(include_filename)
+
+    return counts
+
+
+class _FragmentStream(object):
+    """Writes out the output of an included file while keeping a copy,
+    so it can be written out again if the file is included more than
+    once."""
+
+    def __init__(self, output_stream):
+        self.output_stream = output_stream
+        self.parts = []
+
+    def write(self, text):
+        self.output_stream.write(text)
+        self.parts.append(text)
+
+    def getvalue(self):
+        return u''.join(self.parts)
+
+
 class _DocBookScanner(xml.sax.ContentHandler):
     """Scans a DocBook file and merges them into the appropriate output."""
 
@@ -79,16 +130,44 @@ class _DocBookScanner(xml.sax.ContentHandler):
             include_filename = os.path.abspath(
                 os.path.join(self.input_directory, href))
 
+            # If we already included this file with the same options,
+            # then we can write out the same results without parsing
+            # it again (or copying its media again).
+            include_key = (
+                include_filename,
+                True,
+                self.args.book_chapters,
+                self.args.strip_media,
+                self.args.filter_media,
+                self.args.reduce_media,
+                os.path.relpath(
+                    os.path.dirname(include_filename),
+                    self.args.directory_root))
+
+            if include_key in self.args.include_cache:
+                self.log.info("Including cached file: " + href)
+                self.output_stream.write(self.args.include_cache[include_key])
+                return
+
             # We have a file to include, so add it by creating a new
-            # DocBookScanner that uses the same output file.
+            # DocBookScanner. Most files are only included once, so
+            # they write straight to our output. If the file is
+            # included again, then we also keep a copy of the output
+            # for the other times it is included.
             self.log.info("Including file: " + href)
+            fragment = None
+            output_stream = self.output_stream
+
+            if self.args.include_counts.get(include_filename, 0) > 1:
+                fragment = _FragmentStream(self.output_stream)
+                output_stream = fragment
 
             # Create the parser with the output file and the current path.
             scanner = _DocBookScanner(
                 self.args,
                 include_filename,
                 self.output_filename,
-                self.output_stream, 
+                output_stream,
                 True)
             parser = xml.sax.make_parser()
             parser.setFeature(
@@ -97,6 +176,10 @@ class _DocBookScanner(xml.sax.ContentHandler):
             parser.setContentHandler(scanner)
             parser.parse(include_filename)
 
+            # Keep the results for the next time.
+            if fragment:
+                self.args.include_cache[include_key] = fragment.getvalue()
+
             # We don't continue on, so return.
             return
 
@@ -176,15 +259,9 @@ class _DocBookScanner(xml.sax.ContentHandler):
             if baseref not in self.args.exclude_media:
                 # We aren't ignoring it, so we need to find the absolute
                 # path to it.
-                absfileref = None
-        
-                for media_source in self.args.media_search:
-                    testfileref = os.path.abspath(
-                        os.path.join(media_source, self.relative_dirname, fileref))
-        
-                    if os.path.isfile(testfileref):
-                        absfileref = testfileref
-                        break
+                absfileref = self.args.media_index.find(
+                    os.path.join(self.relative_dirname, fileref),
+                    self.args.warn_ambiguous_media)
         
                 if not absfileref:
                     self.log.error("  Cannot find file: " + fileref)
@@ -205,10 +282,17 @@ class _DocBookScanner(xml.sax.ContentHandler):
                 # Include the file hash to the file to handle duplicate
                 # names that are actually different files. We only use the
                 # first 13 characters because it's "good enough" and prime.
-                file_hash = mfgames_writing.get_file_hash(absfileref)
-                file_hash = file_hash[:13] + "_"
+                full_hash = mfgames_writing.get_file_hash(
+                    absfileref,
+                    cache=self.args.hash_cache)
+                file_hash = full_hash[:13] + "_"
                 
-                if file_hash not in baseref:
+                if full_hash in self.args.media_hashes:
+                    # We are deduplicating media and already have a
+                    # file with the same contents, so use that one even
+                    # if the name is different.
+                    outputref = self.args.media_hashes[full_hash]
+                elif file_hash not in baseref:
                     outputref = os.path.abspath(
                         os.path.join(
                             self.args.media_destination,
@@ -218,6 +302,11 @@ class _DocBookScanner(xml.sax.ContentHandler):
                         self.args.media_destination,
                         baseref)
         
+                # If we are deduplicating, then remember the first file
+                # stored with these contents.
+                if self.args.dedup_media:
+                    self.args.media_hashes.setdefault(full_hash, outputref)
+
                 # Make sure the directory exists.
                 output_directory = os.path.dirname(outputref)
                 output_image = os.path.basename(outputref)
@@ -226,11 +315,11 @@ class _DocBookScanner(xml.sax.ContentHandler):
                     self.log.info("Creating directory: " + output_directory)
                     os.makedirs(output_directory)
         
-                # Copy the file into the proper location.
+                # Queue up the file to be copied into the proper
+                # location. We already know the name, so we don't have
+                # to wait for it.
                 if absfileref != outputref:
-                    self.log.debug("Copying image from: " + absfileref)
-                    shutil.copy(absfileref, outputref)
-                    self.log.info("Copied image file: " + outputref)
+                    self.args.media_queue.add(absfileref, outputref)
         
                 # Set up the image path so we can replace it.
                 image_path = output_image
@@ -352,6 +441,34 @@ class GatherFileProcess(mfgames_tools.process.InputFileProcess):
         if not args.directory_root:
             args.directory_root = os.path.dirname(os.path.abspath(args.file))
 
+        # Media files are hashed for their output names, so keep those
+        # hashes between runs unless we were told not to.
+        args.hash_cache = None
+
+        if args.copy_media and not args.no_hash_cache:
+            args.hash_cache = mfgames_writing.cache.FileHashCache(
+                args.hash_cache_file)
+
+        # Index the media search directories once instead of looking
+        # in each of them for every image.
+        if args.copy_media:
+            args.media_index = mfgames_writing.docbook.media.MediaIndex(
+                args.media_search)
+
+        # Find the files that are included more than once and keep
+        # their output, so those aren't processed every time.
+        args.include_counts = _count_includes(args.file)
+        args.include_cache = {}
+
+        # When deduplicating media, we keep track of the file stored
+        # for each hash so identical files are only stored once.
+        args.media_hashes = {}
+
+        # Media files are copied while we continue parsing.
+        args.media_queue = mfgames_writing.docbook.media.MediaQueue(
+            args.media_mode,
+            args.media_jobs)
+
         # We have everything we need to perform the action. We create
         # an XML reader that will parse through this (and any
         # included) DocBook files and merge them into a single output
@@ -360,10 +477,10 @@ class GatherFileProcess(mfgames_tools.process.InputFileProcess):
 
         # Open the output file.
         if args.output == "-":
-            output = sys.stdout
+            output = mfgames_writing.stream.BufferedWriter(sys.stdout)
         else:
             # We always use UTF-8 without BOM.
-            output = codecs.open(args.output, 'w', 'utf-8')
+            output = mfgames_writing.stream.open_utf8(args.output)
 
         # Create the parser with the output file and the current path.
         scanner = _DocBookScanner(args, args.file, args.output, output, False)
@@ -372,8 +489,26 @@ class GatherFileProcess(mfgames_tools.process.InputFileProcess):
             "http://xml.org/sax/features/external-general-entities",
             False)
         parser.setContentHandler(scanner)
-        parser.parse(args.file)
-        output.close()
+
+        try:
+            parser.parse(args.file)
+        finally:
+            output.close()
+            errors = args.media_queue.wait()
+
+        # Save the hashes for the next run.
+        if args.hash_cache:
+            args.hash_cache.save()
+
+        # Report all the media files we couldn't copy at the same time.
+        if errors:
+            for error in errors:
+                log.error("Cannot copy media file: " + error)
+
+            raise Exception(
+                "Cannot copy media files:"
+                + os.linesep + "  "
+                + (os.linesep + "  ").join(errors))
 
     def setup_arguments(self, parser):
         """Sets up the command-line arguments for processing."""
@@ -442,11 +577,44 @@ class GatherFileProcess(mfgames_tools.process.InputFileProcess):
             type=str,
             nargs="+",
             help="Lists the directories that will be searched for media files. If not set, then the directory of the input file will be used.")
+        parser.add_argument(
+            '--dedup-media',
+            default=False,
+            action='store_true',
+            help="If set, then media files with the same contents are only stored once, even if they have different names, and every reference uses the first one.")
+        parser.add_argument(
+            '--warn-ambiguous-media',
+            default=False,
+            action='store_true',
+            help="If set, then a warning is given when a media file is found in more than one of the search directories.")
         parser.add_argument(
             '--media-destination',
             metavar='DIR',
             type=str,
             help="If set, then media files will be copied here instead of the output. This can be a relative path to the output directory.")
+        parser.add_argument(
+            '--media-mode',
+            type=str,
+            default='copy',
+            choices=['copy', 'link', 'reflink', 'auto'],
+            help="Determines how media files are placed in the output. 'link' uses hard links, 'reflink' uses copy-on-write clones, and 'auto' tries a reflink before falling back to a copy.")
+        parser.add_argument(
+            '--media-jobs',
+            metavar='N',
+            type=int,
+            default=4,
+            help="The number of threads used to copy media files while the XML is being processed. If 0, then files are copied as they are found.")
+        parser.add_argument(
+            '--hash-cache',
+            dest='hash_cache_file',
+            metavar='FILE',
+            type=str,
+            help="The file used to remember media hashes between runs. If not set, then a file in the user's cache directory is used.")
+        parser.add_argument(
+            '--no-hash-cache',
+            default=False,
+            action='store_true',
+            help="If set, then media files are always hashed instead of using the hashes from previous runs.")
 
     def get_help(self):
         return "Merges a DocBook file and all includes and gathers up external resources such as images."
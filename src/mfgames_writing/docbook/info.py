@@ -2,13 +2,17 @@
 producing output based on its contents."""
 
 
+import argparse
 import lxml.etree
 import codecs
 import mfgames_tools
-import mfgames_writing.docbook.scan
+import mfgames_writing.docbook.backend
+import mfgames_writing.docbook.metadata
+import multiprocessing
 import os
+import re
 import sys
-import xml
+import xml.sax
 
 
 # The namespaces used as part of the XPath queries.
@@ -16,6 +20,40 @@ docbook_ns = "http://docbook.org/ns/docbook"
 docbook_lxml_ns = "{%s}" % docbook_ns
 xml_ns = {'d': docbook_ns }
 
+# The elements that can come before the contents of a DocBook
+# element, which are the only ones loaded for --info-only.
+header_elements = ['info', 'title', 'subtitle', 'titleabbrev']
+
+# The virtual elements added by the query, which are only created if
+# one of the expressions uses them.
+virtual_elements = ['fullname', 'fulltitle', 'abspath']
+
+# The names of the elements in an XPath expression, with their prefix.
+_xpath_name = re.compile(r'[\w.-]+(?::[\w.-]+)?', re.UNICODE)
+
+# The XPath expressions for finding where to put the virtual elements.
+_personname_xpath = lxml.etree.XPath("//d:personname", namespaces=xml_ns)
+_info_xpath = lxml.etree.XPath("//d:info", namespaces=xml_ns)
+
+# The fields kept in the metadata index along with the select
+# expression, relative to the default select root, that gives the same
+# values. Queries only using these can be answered from the index.
+default_select_root = "/*/d:info"
+metadata_fields = [
+    ('title', "d:title"),
+    ('subtitle', "d:subtitle"),
+    ('fulltitle', "d:fulltitle"),
+    ('author', "d:author/d:personname/d:fullname"),
+    ('date', "d:date"),
+    ('pubdate', "d:pubdate"),
+    ('subject', "d:subjectset/d:subject/d:subjectterm"),
+    ('abspath', "d:abspath"),
+]
+_metadata_root_xpath = lxml.etree.XPath(default_select_root, namespaces=xml_ns)
+_metadata_xpaths = [
+    (name, lxml.etree.XPath(select, namespaces=xml_ns))
+    for name, select in metadata_fields]
+
 
 def _get_element_value(node, tag, default):
     """Tries to get the first text element of the given tag, or the
@@ -37,6 +75,140 @@ def _get_element_node(node, tag, default):
     return default
 
 
+def _parse_header(filename):
+    """Loads the root element of the file with only the header
+    elements (e.g., info or title) that come before its contents.
+
+    The file is read until the first child of the root that isn't a
+    header element starts, which for most files is only the first few
+    kilobytes.
+    """
+
+    stream = open(filename, 'rb')
+
+    try:
+        depth = 0
+        root = None
+
+        for event, element in lxml.etree.iterparse(
+            stream,
+            events=('start', 'end')):
+            if event == 'end':
+                depth -= 1
+                continue
+
+            depth += 1
+
+            if depth == 1:
+                root = element
+                continue
+
+            # We only care about the direct children of the root.
+            if depth > 2:
+                continue
+
+            if lxml.etree.QName(element).localname not in header_elements:
+                # This is the start of the contents, so stop reading
+                # the file. The parser reads ahead, so there may be
+                # more than the partial element to remove.
+                while element.getnext() is not None:
+                    root.remove(element.getnext())
+
+                root.remove(element)
+                break
+
+        return lxml.etree.ElementTree(root)
+    finally:
+        stream.close()
+
+
+class _SubjectsetScanner(xml.sax.ContentHandler):
+    """Collects the subject terms in a file, grouped by the schema of
+    their subject set."""
+
+    def __init__(self):
+        xml.sax.ContentHandler.__init__(self)
+
+        self.subjectsets = {}
+        self.subjectset_schema = None
+        self.capture_buffer = False
+        self.buffer = unicode()
+
+    def characters(self, contents):
+        if self.capture_buffer:
+            self.buffer += contents
+
+    def startElement(self, name, attrs):
+        if name == "subjectset":
+            self.subjectset_schema = attrs.get('schema') or None
+
+        if name == "subjectterm":
+            self.capture_buffer = True
+
+    def endElement(self, name):
+        if name == "subjectterm":
+            terms = self.subjectsets.setdefault(self.subjectset_schema, [])
+            term = self.buffer.strip()
+
+            if term not in terms:
+                terms.append(term)
+
+            self.buffer = unicode()
+            self.capture_buffer = False
+
+
+def _extract_subjectsets(job):
+    """Gets the tab-separated lines of subject terms for a single
+    file, given the filename and the parser to use. This is a function
+    so it can be run in a worker process."""
+
+    input_filename, backend = job
+    scanner = _SubjectsetScanner()
+    mfgames_writing.docbook.backend.parse(
+        scanner,
+        input_filename,
+        backend,
+        ["subjectset", "subjectterm"],
+        ["subjectterm"])
+
+    lines = []
+
+    for subjectset in sorted(scanner.subjectsets.keys()):
+        # We can have a None for the subject set, replace this with
+        # blank.
+        setname = subjectset
+
+        if not subjectset:
+            setname = ''
+
+        for subjectterm in sorted(scanner.subjectsets[subjectset]):
+            parts = [
+                input_filename,
+                setname,
+                subjectterm]
+            lines.append('\t'.join(parts))
+
+    return lines
+
+
+def _get_worker_error(filename, error):
+    """Gets the exception to send back from a worker process when a
+    file fails. The pool hangs if an exception can't be sent back,
+    which is the case for lxml's, so this is always a plain one."""
+
+    return Exception("Cannot read " + filename + ": " + str(error))
+
+
+def _extract_worker_subjectsets(job):
+    """Gets the lines of subject terms for a single file inside a
+    worker process."""
+
+    try:
+        return _extract_subjectsets(job)
+    except Exception as e:
+        raise _get_worker_error(job[0], e)
+
+
 class ExtractSubjectsetsProcess(mfgames_tools.process.InputFilesProcess):
     """Scans the DocBook file and extracts the subject sets."""
 
@@ -44,7 +216,6 @@ class ExtractSubjectsetsProcess(mfgames_tools.process.InputFilesProcess):
         super(ExtractSubjectsetsProcess, self).__init__()
 
         self.args = None
-        self.structure = None
 
     def get_help(self):
         """Returns the help string for the process."""
@@ -68,47 +239,39 @@ class ExtractSubjectsetsProcess(mfgames_tools.process.InputFilesProcess):
         else:
             output = sys.stdout
 
-        # Go through all the input files.
-        for filename in args.files:
-            self.process_file(args, filename, output)
+        # Go through all the input files, either one at a time or in
+        # parallel. Either way, the results are written in the same
+        # order as the files.
+        if args.jobs <= 1:
+            for filename in args.files:
+                self.process_file(args, filename, output)
+
+            return
+
+        pool = multiprocessing.Pool(args.jobs)
+
+        try:
+            jobs = [(filename, args.parser) for filename in args.files]
+
+            for lines in pool.imap(_extract_worker_subjectsets, jobs, 16):
+                self.write_lines(lines, output)
+        finally:
+            pool.terminate()
+            pool.join()
 
     def process_file(self, args, input_filename, output):
-        """Converts the given file into Creole."""
-
-        # Go through the file and build up the structural elements of
-        # the document. This is used to determine chunking and file
-        # generation.
-        self.structure = mfgames_writing.docbook.scan._StructureScanner(
-            self,
-            '')
-        parser = xml.sax.make_parser()
-        parser.setFeature(
-            "http://xml.org/sax/features/external-general-entities",
-            False)
-        parser.setContentHandler(self.structure)
-        parser.parse(open(input_filename))
-
-        # Get all the subjects from the root element.
-        subjectsets = {}
-        self.structure.root_entry.get_subjectsets(subjectsets)
-
-        # Check on the output format.
-        if args.output_format == 'tsv':
-            for subjectset in sorted(subjectsets.keys()):
-                # We can have a None for the subject set, replace this with
-                # blank.
-                setname = subjectset
-
-                if not subjectset:
-                    setname = ''
-
-                for subjectterm in sorted(subjectsets[subjectset]):
-                    parts = [
-                        input_filename,
-                        setname,
-                        subjectterm]
-                    output.write('\t'.join(parts))
-                    output.write(os.linesep)
+        """Extracts the subject sets from a single file."""
+
+        self.write_lines(
+            _extract_subjectsets((input_filename, args.parser)),
+            output)
+
+    def write_lines(self, lines, output):
+        """Writes out the lines for a single file."""
+
+        for line in lines:
+            output.write(line)
+            output.write(os.linesep)
 
     def setup_arguments(self, parser):
         """Sets up the command-line arguments for file processing."""
@@ -133,6 +296,117 @@ class ExtractSubjectsetsProcess(mfgames_tools.process.InputFilesProcess):
             type=str,
             help="If not set to 'no', will chunk at chapters using the "
                 + "value with substituting {id} and {number} in the string.")
+        parser.add_argument(
+            '--jobs', '-j',
+            default=1,
+            type=int,
+            help="The number of processes used to read the files. The "
+                + "results are still written in the order of the files.")
+        mfgames_writing.docbook.backend.add_parser_argument(parser)
+
+
+def _compile_query(args):
+    """Compiles the XPath expressions of the query and figures out
+    which virtual elements they use."""
+
+    args.select_root_xpath = lxml.etree.XPath(
+        args.select_root,
+        namespaces=xml_ns)
+    args.select_xpaths = [
+        lxml.etree.XPath(select, namespaces=xml_ns)
+        for select in args.select]
+
+    # Figure out which virtual elements are used by the expressions
+    # so we only create those. The names in the expressions may have
+    # a prefix, but a longer name that contains one (e.g.,
+    # d:fulltitles) doesn't count.
+    used = set()
+
+    for expression in [args.select_root] + args.select:
+        used.update([
+            match.split(":")[-1]
+            for match in _xpath_name.findall(expression)])
+
+    args.virtual_elements = [
+        name for name in virtual_elements
+        if name in used]
+
+
+# The query used by each worker process when there are multiple jobs.
+_worker_query = None
+
+
+def _init_query_worker(args):
+    """Sets up the query inside a worker process. The compiled XPath
+    expressions can't be passed between processes, so each worker
+    compiles its own."""
+
+    global _worker_query
+
+    _compile_query(args)
+    _worker_query = QueryProcess()
+    _worker_query.args = args
+
+
+def _query_worker_file(filename):
+    """Queries a single file inside a worker process."""
+
+    try:
+        return _worker_query.query_file(filename)
+    except Exception as e:
+        raise _get_worker_error(filename, e)
+
+
+def _get_values(select_roots, select_xpath):
+    """Gets the text values of the select expression for each of the
+    roots."""
+
+    values = []
+
+    for select_root in select_roots:
+        # Perform the query on the select root for the path.
+        selects = select_xpath(select_root)
+
+        for select in selects:
+            if select is None:
+                continue
+            if isinstance(select, basestring):
+                values.append(select)
+            else:
+                if select.text is not None:
+                    values.append(select.text)
+
+    return values
+
+
+def _parse_where(where):
+    """Parses a where clause of FIELD=VALUE for an exact match or
+    FIELD~VALUE for a regular expression, returning the field name,
+    operator, and value."""
+
+    match = re.match(r'^(\w+)([=~])(.*)$', where)
+
+    if not match:
+        raise Exception(
+            "Cannot parse where clause '" + where + "', it must be "
+            + "FIELD=VALUE or FIELD~VALUE.")
+
+    name, operator, value = match.groups()
+    names = [field for field, select in metadata_fields]
+
+    if name not in names:
+        raise Exception(
+            "Unknown where field '" + name + "', it must be one of: "
+            + ", ".join(names))
+
+    # The values in the metadata are Unicode, so match against that.
+    if isinstance(value, str):
+        value = value.decode('utf-8')
+
+    if operator == '~':
+        value = re.compile(value)
+
+    return name, operator, value
 
 
 class QueryProcess(mfgames_tools.process.InputFilesProcess):
@@ -148,41 +422,180 @@ class QueryProcess(mfgames_tools.process.InputFilesProcess):
         return "Scans DocBook and outputs the results."
 
     def process(self, args):
+        # The workers only get the arguments they need, since they
+        # have to be copied into each process.
+        worker_args = argparse.Namespace(
+            select_root=args.select_root,
+            select=args.select,
+            info_only=args.info_only)
+
+        # Compile the XPath expressions once since they are used for
+        # every file.
+        _compile_query(args)
+        args.where_clauses = [_parse_where(where) for where in args.where]
+
+        # Open the metadata index if we are filtering the files or we
+        # were given one to use.
+        args.metadata_index = None
+
+        if not args.no_index and (args.where or args.index_file):
+            args.metadata_index = \
+                mfgames_writing.docbook.metadata.MetadataIndex(
+                    args.index_file)
+
+        # If we have the index and all the select expressions are in
+        # the metadata, then we don't have to open the files.
+        selects = dict([(select, name) for name, select in metadata_fields])
+        args.select_fields = None
+
+        if (args.metadata_index
+            and args.select_root == default_select_root
+            and not [select for select in args.select
+                     if select not in selects]):
+            args.select_fields = [selects[select] for select in args.select]
+
         # Call the parent class' implementation which ensures all the
-        # files exists and sets up the internal arguments.
-        super(QueryProcess, self).process(args)
+        # files exists and sets up the internal arguments. If we have
+        # multiple jobs, this only collects the files to query.
+        self.pending = []
+
+        try:
+            super(QueryProcess, self).process(args)
+
+            if not self.pending:
+                return
+
+            # Query the files in parallel, but write out the results
+            # in the same order as the files were given.
+            pool = multiprocessing.Pool(
+                args.jobs,
+                _init_query_worker,
+                (worker_args,))
+
+            try:
+                for row in pool.imap(_query_worker_file, self.pending, 16):
+                    print row
+            finally:
+                pool.terminate()
+                pool.join()
+        finally:
+            if args.metadata_index:
+                args.metadata_index.close()
 
     def process_file(self, input_filename):
         """Processes a single DocBook 5 file and determines if it
         should be filtered out, if not, then it outputs the
         results."""
 
-        # Load the entire XML file into memory.
-        xml = lxml.etree.parse(input_filename)
+        # Filter out the files that don't match the where clause,
+        # which only needs the metadata.
+        metadata = None
+
+        if self.args.where or self.args.select_fields:
+            metadata = self.get_metadata(input_filename)
+
+        if not self.is_match(metadata):
+            return
+
+        # If the metadata has everything we need, then we are done.
+        if self.args.select_fields:
+            print "\t".join([
+                ", ".join(metadata.get(name, []))
+                for name in self.args.select_fields])
+            return
+
+        # If we are running in parallel, the file is queried later.
+        if self.args.jobs > 1:
+            self.pending.append(input_filename)
+            return
+
+        print self.query_file(input_filename)
+
+    def query_file(self, input_filename):
+        """Queries a single file and returns the line of results."""
+
+        # Load the XML file into memory, either the entire file or
+        # just enough of it to get the information at the top.
+        if self.args.info_only:
+            xml = _parse_header(input_filename)
+        else:
+            xml = lxml.etree.parse(input_filename)
 
         # Make some virtual nodes into the XML.
         self.add_virtual_elements(xml, input_filename)
 
-        # TODO: Perform the where clause to filter it out.
-
         # If we got this far, this file needs to have its fields
         # written out.
-        self.select_file(xml)
+        return self.select_file(xml)
+
+    def get_metadata(self, filename):
+        """Gets the fields of the file used for the where clause,
+        from the index if we have one."""
+
+        if self.args.metadata_index:
+            return self.args.metadata_index.get_metadata(
+                filename,
+                self.read_metadata)
+
+        return self.read_metadata(filename)
+
+    def read_metadata(self, filename):
+        """Reads the fields of the metadata from the top of the
+        file, using the same expressions as a select would."""
+
+        xml = _parse_header(filename)
+        self.add_virtual_elements(xml, filename, virtual_elements)
+        info_roots = _metadata_root_xpath(xml)
+        metadata = {}
+
+        for name, select_xpath in _metadata_xpaths:
+            values = _get_values(info_roots, select_xpath)
 
-    def add_virtual_elements(self, xml, filename):
+            if values:
+                metadata[name] = values
+
+        return metadata
+
+    def is_match(self, metadata):
+        """Determines if the metadata matches all of the where
+        clauses."""
+
+        for name, operator, value in self.args.where_clauses:
+            values = metadata.get(name, [])
+
+            if operator == '=':
+                if value not in values:
+                    return False
+            elif not [field for field in values if value.search(field)]:
+                return False
+
+        return True
+
+    def add_virtual_elements(self, xml, filename, used=None):
         """Adds in virtual elements into the XML tree to represent
-        information about the file or formatting."""
+        information about the file or formatting. Only the elements
+        used by the expressions are added."""
+
+        if used is None:
+            used = self.args.virtual_elements
 
         # Go through all the author tags and add a formatted version.
-        for info in xml.xpath("//d:personname", namespaces=xml_ns):
+        if "fullname" not in used:
+            personnames = []
+        else:
+            personnames = _personname_xpath(xml)
+
+        for info in personnames:
             # Pull out the components of the name.
             firstname = _get_element_value(info, "firstname", None)
             surname = _get_element_value(info, "surname", None)
 
             name = surname
-            
-            if firstname:
+
+            if firstname and name:
                 name += ", " + firstname
+            elif firstname:
+                name = firstname
 
             # Pull the name back in.
             fullname = lxml.etree.Element(docbook_lxml_ns + "fullname")
@@ -191,66 +604,62 @@ class QueryProcess(mfgames_tools.process.InputFilesProcess):
 
         # Go through all the info tags and add a formatted version of
         # the titles.
-        for info in xml.xpath("//d:info", namespaces=xml_ns):
+        if "fulltitle" not in used and "abspath" not in used:
+            infos = []
+        else:
+            infos = _info_xpath(xml)
+
+        for info in infos:
             # Pull out the components of the name.
-            title = _get_element_value(info, "title", None)
-            subtitle = _get_element_value(info, "subtitle", None)
+            if "fulltitle" in used:
+                title = _get_element_value(info, "title", None)
+                subtitle = _get_element_value(info, "subtitle", None)
 
-            combined = title
-            
-            if subtitle:
-                combined += ": " + subtitle
+                combined = title
 
-            # Pull the name back in.
-            fulltitle = lxml.etree.Element(docbook_lxml_ns + "fulltitle")
-            fulltitle.text = combined
-            info.append(fulltitle)
+                if subtitle and combined:
+                    combined += ": " + subtitle
+                elif subtitle:
+                    combined = subtitle
+
+                # Pull the name back in.
+                fulltitle = lxml.etree.Element(docbook_lxml_ns + "fulltitle")
+                fulltitle.text = combined
+                info.append(fulltitle)
 
             # Put in the absolute filename.
+            if "abspath" not in used:
+                continue
+
             abspath = lxml.etree.Element(docbook_lxml_ns + "abspath")
             abspath.text = os.path.abspath(filename)
             info.append(abspath)
 
     def select_file(self, xml):
-        """Retrieves the fields from the given XML file and writes it
-        out to the stream."""
+        """Retrieves the fields from the given XML file and returns
+        them as a tab-separated line."""
 
         # Go through the select expressions and process each one.
         fields = []
 
         # Get the root for the select query and keep it since we'll
         # loop through these quite a few times (once per field).
-        select_roots = xml.xpath(self.args.select_root, namespaces=xml_ns)
+        select_roots = self.args.select_root_xpath(xml)
 
         # Go through each of the select queries first. We treat these
         # as a single field which we'll combine together.
-        for select_xpath in self.args.select:
+        for select_xpath in self.args.select_xpaths:
             # Create a list of results we find from this field, which
             # we'll combine together into a single "field".
-            values = []
-
-            # Loop through all the resulting root nodes so we can do a
-            # xpath against the root.
-            for select_root in select_roots:
-                # Perform the query on the select root for the path.
-                selects = select_root.xpath(select_xpath, namespaces=xml_ns)
-
-                for select in selects:
-                    if select is None:
-                        continue
-                    if isinstance(select, basestring):
-                        values.append(select)
-                    else:
-                        if select.text is not None:
-                            values.append(select.text)
+            values = _get_values(select_roots, select_xpath)
 
             # Once we finish gathering up all the values, we combine
             # them together and add it to the resulting output fields.
             value_string = ", ".join(values)
             fields.append(value_string)
 
-        # Output the resulting fields to the output stream.
-        print "\t".join(fields)
+        # Combine the resulting fields into a single line.
+        return "\t".join(fields)
 
     def setup_arguments(self, parser):
         """Sets up the command-line arguments for file processing."""
@@ -271,3 +680,41 @@ class QueryProcess(mfgames_tools.process.InputFilesProcess):
             type=str,
             nargs='+',
             help="The relative XPath elements to return in the results.")
+        parser.add_argument(
+            '--info-only', '-i',
+            default=False,
+            action='store_true',
+            help="If set, then only the info and title elements at the "
+            + "top of each file are loaded. The rest of the file is "
+            + "never read, so queries outside of those will not find "
+            + "anything.")
+        parser.add_argument(
+            '--jobs', '-j',
+            default=1,
+            type=int,
+            help="The number of processes used to query the files. The "
+            + "results are still written in the order of the files.")
+        parser.add_argument(
+            '--where', '-w',
+            default=[],
+            action='append',
+            help="Only shows files where the field matches, either "
+            + "FIELD=VALUE for an exact match or FIELD~VALUE for a "
+            + "regular expression. The fields are "
+            + ", ".join([name for name, select in metadata_fields])
+            + ". If given more than once, all of them must match.")
+        parser.add_argument(
+            '--index-file',
+            metavar='FILE',
+            type=str,
+            help="The file used to remember the metadata of each file "
+            + "between runs, which is also used to answer selects that "
+            + "only need the metadata. If not set, then the index is only "
+            + "used with --where and is kept in the user's cache "
+            + "directory.")
+        parser.add_argument(
+            '--no-index',
+            default=False,
+            action='store_true',
+            help="If set, then the metadata is always read from the files "
+            + "instead of using the index.")
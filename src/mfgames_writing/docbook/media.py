@@ -0,0 +1,296 @@
+"""Handles the media files (e.g., images) referenced by DocBook files
+while they are being gathered."""
+
+
+import Queue
+import hashlib
+import logging
+import os
+import shutil
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# The ioctl request for cloning a file on Linux (FICLONE), which is
+# used for reflinks on file systems that support them.
+_FICLONE = 0x40049409
+
+# How much of the start of a file is compared when seeing if the
+# destination is already up to date.
+_PREFIX_SIZE = 2**16
+
+
+def get_prefix_hash(filename):
+    """Retrieves the SHA-256 hash of the start of the file."""
+
+    stream = open(filename, 'rb')
+
+    try:
+        return hashlib.sha256(stream.read(_PREFIX_SIZE)).hexdigest()
+    finally:
+        stream.close()
+
+
+def is_up_to_date(source, destination):
+    """Determines if the destination already has the same contents as
+    the source.
+
+    The destination must have the same size and be at least as new as
+    the source. To catch a destination that was replaced by something
+    else of the same size, the start of both files is also compared.
+    A hard link to the source is always up to date.
+    """
+
+    try:
+        destination_stat = os.stat(destination)
+    except OSError:
+        return False
+
+    source_stat = os.stat(source)
+
+    if (source_stat.st_ino == destination_stat.st_ino
+        and source_stat.st_dev == destination_stat.st_dev):
+        return True
+
+    if source_stat.st_size != destination_stat.st_size:
+        return False
+
+    # Copying the modification time only keeps whole microseconds, so
+    # the times are compared to the second.
+    if int(destination_stat.st_mtime) < int(source_stat.st_mtime):
+        return False
+
+    return get_prefix_hash(source) == get_prefix_hash(destination)
+
+
+def reflink(source, destination):
+    """Creates a copy-on-write clone of the source file. This raises
+    an IOError if the file system doesn't support it."""
+
+    if not fcntl:
+        raise IOError("Reflinks are not supported on this platform")
+
+    source_stream = open(source, 'rb')
+
+    try:
+        destination_stream = open(destination, 'wb')
+
+        try:
+            fcntl.ioctl(
+                destination_stream.fileno(),
+                _FICLONE,
+                source_stream.fileno())
+        except:
+            destination_stream.close()
+            os.remove(destination)
+            raise
+
+        destination_stream.close()
+    finally:
+        source_stream.close()
+
+    shutil.copystat(source, destination)
+
+
+def place_media(source, destination, mode):
+    """Places the source file at the destination.
+
+    The mode is 'copy' for a plain copy, 'link' for a hard link, and
+    'reflink' for a copy-on-write clone. 'auto' tries a reflink and
+    falls back to a copy. Hard links are never picked automatically,
+    since changing the output would also change the source.
+    """
+
+    # Always remove the old file first. Otherwise, copying over a hard
+    # link would write through to whatever it was linked to.
+    if os.path.lexists(destination):
+        os.remove(destination)
+
+    if mode == 'link':
+        os.link(source, destination)
+        return
+
+    if mode == 'reflink' or mode == 'auto':
+        try:
+            reflink(source, destination)
+            return
+        except (IOError, OSError):
+            if mode == 'reflink':
+                raise
+
+    # The copy keeps the modification time so the next run can see
+    # the file is up to date.
+    shutil.copy2(source, destination)
+
+
+class MediaIndex(object):
+    """An index of the files inside the media search directories.
+
+    Each directory is only listed the first time a media file is
+    looked for inside of it. After that, finding a media file in that
+    directory is a set lookup instead of checking for the file in
+    every search directory. Directories that never have media files,
+    such as a .git directory or symbolic links back up the tree, are
+    never looked at.
+    """
+
+    def __init__(self, search_directories):
+        self.log = logging.getLogger('media')
+        self.search_directories = [
+            os.path.abspath(directory) for directory in search_directories]
+        self.listings = {}
+
+    def list_directory(self, directory):
+        """Gets the names inside the directory, listing it the first
+        time it is needed."""
+
+        names = self.listings.get(directory)
+
+        if names is None:
+            try:
+                names = set(os.listdir(directory))
+            except OSError:
+                names = set()
+
+            self.listings[directory] = names
+
+        return names
+
+    def iter_paths(self, relative_path):
+        """Goes through the files for the path relative to the search
+        directories, in the order of the search directories. Each
+        directory is only checked when the next file is asked for."""
+
+        seen = set()
+
+        for directory in self.search_directories:
+            path = os.path.abspath(os.path.join(directory, relative_path))
+            dirname, basename = os.path.split(path)
+
+            if (path not in seen
+                and basename in self.list_directory(dirname)
+                and os.path.isfile(path)):
+                seen.add(path)
+                yield path
+
+    def find_all(self, relative_path):
+        """Finds all the files for the path relative to the search
+        directories, in the order of the search directories."""
+
+        return list(self.iter_paths(relative_path))
+
+    def find(self, relative_path, warn_ambiguous=False):
+        """Finds the first file for the path relative to the search
+        directories, or None if it can't be found.
+
+        If warn_ambiguous is set, then a warning is logged when more
+        than one search directory has the file. Otherwise, the search
+        stops at the first directory that has it.
+        """
+
+        if not warn_ambiguous:
+            return next(self.iter_paths(relative_path), None)
+
+        paths = self.find_all(relative_path)
+
+        if not paths:
+            return None
+
+        if len(paths) > 1:
+            self.log.warning(
+                "Ambiguous media file " + relative_path + ", using "
+                + paths[0] + " instead of " + ", ".join(paths[1:]))
+
+        return paths[0]
+
+
+class MediaQueue(object):
+    """Places media files using a bounded pool of threads.
+
+    This lets the XML keep streaming while the files are being
+    copied. Failures are collected instead of stopping the other
+    copies, so they can all be reported together at the end. If there
+    are no jobs, then files are placed as soon as they are added.
+    """
+
+    def __init__(self, mode, jobs):
+        self.log = logging.getLogger('media')
+        self.mode = mode
+        self.jobs = jobs
+        self.errors = []
+        self.destinations = set()
+        self.lock = threading.Lock()
+
+        # Limit how many files can be waiting so we don't get too far
+        # ahead of the copying.
+        self.queue = Queue.Queue(jobs * 4)
+        self.threads = []
+
+        for index in range(jobs):
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def add(self, source, destination):
+        """Adds a file to be placed at the destination. A destination
+        is only placed once, even if it is added more than once."""
+
+        if destination in self.destinations:
+            return
+
+        self.destinations.add(destination)
+
+        if self.jobs > 0:
+            self.queue.put((source, destination))
+        else:
+            self.place(source, destination)
+
+    def place(self, source, destination):
+        """Places a single file, unless it is already up to date."""
+
+        if is_up_to_date(source, destination):
+            self.log.debug("Image file is up to date: " + destination)
+            return
+
+        self.log.debug("Copying image from: " + source)
+        place_media(source, destination, self.mode)
+        self.log.info("Copied image file: " + destination)
+
+    def run(self):
+        """Places files from the queue until told to stop."""
+
+        while True:
+            job = self.queue.get()
+
+            if job is None:
+                return
+
+            source, destination = job
+
+            try:
+                self.place(source, destination)
+            except Exception as exception:
+                with self.lock:
+                    self.errors.append(
+                        "{0} -> {1}: {2}".format(
+                            source,
+                            destination,
+                            exception))
+
+    def wait(self):
+        """Waits for all the files to be placed and returns a list of
+        the failures, if any."""
+
+        for thread in self.threads:
+            self.queue.put(None)
+
+        for thread in self.threads:
+            thread.join()
+
+        self.threads = []
+        return self.errors
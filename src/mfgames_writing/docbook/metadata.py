@@ -0,0 +1,103 @@
+"""Keeps a persistent index of the information at the top of DocBook
+files so queries don't have to parse them every time."""
+
+
+import mfgames_writing.cache
+import os
+import sqlite3
+
+
+class MetadataIndex(object):
+    """An SQLite index of the fields in each file.
+
+    The fields of a file are used if the size and modification time
+    of the file haven't changed. If they have, then the file is hashed
+    and only read again if the contents are different.
+    """
+
+    def __init__(self, filename=None):
+        if not filename:
+            filename = mfgames_writing.cache.get_cache_filename(
+                'metadata.sqlite')
+
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            + "abspath TEXT PRIMARY KEY, size INTEGER, mtime REAL, "
+            + "hash TEXT)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS fields ("
+            + "abspath TEXT, name TEXT, position INTEGER, value TEXT)")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS fields_abspath ON fields (abspath)")
+
+        # Load the list of files up front since we check every one.
+        self.files = {}
+
+        for abspath, size, mtime, file_hash in self.connection.execute(
+            "SELECT abspath, size, mtime, hash FROM files"):
+            self.files[abspath] = (size, mtime, file_hash)
+
+    def get_metadata(self, filename, read):
+        """Gets the fields of the file as a dictionary of lists of
+        values, calling read with the filename if the file changed."""
+
+        abs_filename = os.path.abspath(filename)
+        state = mfgames_writing.cache.FileState(abs_filename)
+        entry = self.files.get(abs_filename)
+
+        if state.is_unchanged(entry):
+            return self.load_fields(abs_filename)
+
+        if state.is_same(entry):
+            metadata = self.load_fields(abs_filename)
+        else:
+            metadata = read(abs_filename)
+            self.save_fields(abs_filename, metadata)
+
+        self.files[abs_filename] = tuple(state.get_entry())
+        self.connection.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+            (abs_filename,) + self.files[abs_filename])
+        return metadata
+
+    def load_fields(self, abs_filename):
+        """Loads the fields of a file from the index."""
+
+        metadata = {}
+
+        for name, value in self.connection.execute(
+            "SELECT name, value FROM fields WHERE abspath = ? "
+            + "ORDER BY position",
+            (abs_filename,)):
+            metadata.setdefault(name, []).append(value)
+
+        return metadata
+
+    def save_fields(self, abs_filename, metadata):
+        """Replaces the fields of a file in the index."""
+
+        self.connection.execute(
+            "DELETE FROM fields WHERE abspath = ?",
+            (abs_filename,))
+
+        position = 0
+
+        for name in sorted(metadata.keys()):
+            for value in metadata[name]:
+                self.connection.execute(
+                    "INSERT INTO fields VALUES (?, ?, ?, ?)",
+                    (abs_filename, name, position, value))
+                position += 1
+
+    def save(self):
+        """Writes out any changes to the index."""
+
+        self.connection.commit()
+
+    def close(self):
+        """Writes out any changes and closes the index."""
+
+        self.save()
+        self.connection.close()
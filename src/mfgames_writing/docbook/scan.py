@@ -3,6 +3,7 @@
 
 import codecs
 import mfgames_tools.process
+import mfgames_writing.docbook.backend
 import os
 import sys
 import xml.sax
@@ -58,7 +59,11 @@ class _StructureEntry(object):
         else:
             self.number = 0
 
-        chunk_chapter = scanner.process.args.chunk_chapter
+        # Not every process that scans the structure can chunk.
+        chunk_chapter = getattr(
+            scanner.process.args,
+            'chunk_chapter',
+            'no')
 
         if xml_element == "chapter" and chunk_chapter != 'no':
             filename = chunk_chapter.format(
@@ -243,6 +248,18 @@ class _StructureScanner(xml.sax.ContentHandler):
             self.depth = self.depth - 1
             self.entry = self.entry.parent
 
+    def parse(self, filename, backend):
+        """Parses the given file using the backend to build up the
+        structure."""
+
+        mfgames_writing.docbook.backend.parse(
+            self,
+            filename,
+            backend,
+            ["book", "article", "chapter", "section", "title",
+             "subjectset", "subjectterm"],
+            ["title", "subjectterm"])
+
     def get_output_filename(self, basename):
         """Takes a base filename and adds the same directory and
         extension as the base file."""
@@ -274,12 +291,7 @@ class ScanDocbookFilesProcess(mfgames_tools.process.ConvertFilesProcess):
         # the document. This is used to determine chunking and file
         # generation.
         self.structure = _StructureScanner(self, output_filename)
-        parser = xml.sax.make_parser()
-        parser.setFeature(
-            "http://xml.org/sax/features/external-general-entities",
-            False)
-        parser.setContentHandler(self.structure)
-        parser.parse(open(input_filename))
+        self.structure.parse(input_filename, args.parser)
 
         if args.dump_structure:
             print('Dumping Structure')
@@ -305,3 +317,4 @@ class ScanDocbookFilesProcess(mfgames_tools.process.ConvertFilesProcess):
             const=True,
             nargs='?',
             help="If set, the file structure will be dumped to stdout.") 
+        mfgames_writing.docbook.backend.add_parser_argument(parser)
@@ -0,0 +1,431 @@
+"""Maintains a full-text index of the paragraphs in DocBook files and
+searches it for words and phrases."""
+
+
+import logging
+import mfgames_tools.process
+import mfgames_writing.cache
+import mfgames_writing.docbook.scan
+import os
+import re
+import sqlite3
+
+
+# The pattern for splitting paragraphs and queries into terms.
+_TERM = re.compile(r'\w+', re.UNICODE)
+
+# The elements whose text is indexed as a paragraph.
+_PARAGRAPHS = ["para", "simpara"]
+
+
+def get_terms(text):
+    """Splits the text into the lowercase terms that are indexed."""
+
+    return [term.lower() for term in _TERM.findall(text)]
+
+
+class _IndexScanner(mfgames_writing.docbook.scan._StructureScanner):
+    """Builds up the structure of the file while collecting the text
+    of each paragraph along with the chapter it is in."""
+
+    def __init__(self, process):
+        mfgames_writing.docbook.scan._StructureScanner.__init__(
+            self,
+            process,
+            None)
+
+        self.paragraphs = []
+        self.paragraph_depth = 0
+        self.paragraph_buffer = []
+        self.paragraph_numbers = {}
+
+    def characters(self, contents):
+        mfgames_writing.docbook.scan._StructureScanner.characters(
+            self,
+            contents)
+
+        if self.paragraph_depth:
+            self.paragraph_buffer.append(contents)
+
+    def startElement(self, name, attrs):
+        mfgames_writing.docbook.scan._StructureScanner.startElement(
+            self,
+            name,
+            attrs)
+
+        # Paragraphs inside of paragraphs (e.g., footnotes) are
+        # treated as part of the outer one, but kept as separate words.
+        if name in _PARAGRAPHS:
+            if self.paragraph_depth:
+                self.paragraph_buffer.append(u" ")
+
+            self.paragraph_depth += 1
+
+    def endElement(self, name):
+        if name in _PARAGRAPHS:
+            self.paragraph_depth -= 1
+
+            if self.paragraph_depth:
+                self.paragraph_buffer.append(u" ")
+            else:
+                self.add_paragraph(u''.join(self.paragraph_buffer))
+                self.paragraph_buffer = []
+
+        mfgames_writing.docbook.scan._StructureScanner.endElement(
+            self,
+            name)
+
+    def add_paragraph(self, text):
+        """Adds a paragraph, numbered from the start of its chapter."""
+
+        # Find the chapter we are inside of, if any.
+        chapter = self.entry
+
+        while chapter and chapter.docbook_element != "chapter":
+            chapter = chapter.parent
+
+        if not chapter:
+            label = u""
+        elif chapter.docbook_id:
+            label = chapter.docbook_id
+        else:
+            label = unicode(chapter.number)
+
+        number = self.paragraph_numbers.get(chapter, 0) + 1
+        self.paragraph_numbers[chapter] = number
+        self.paragraphs.append((label, number, text))
+
+
+class SearchIndex(object):
+    """An SQLite inverted index of the terms in each paragraph.
+
+    Each term in a paragraph has a posting with the positions of the
+    term, which is used to find phrases. A file is only indexed again
+    if its size or modification time changed and it has a different
+    hash than when it was indexed.
+    """
+
+    def __init__(self, filename=None):
+        if not filename:
+            filename = mfgames_writing.cache.get_cache_filename(
+                'search.sqlite')
+
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            + "id INTEGER PRIMARY KEY, abspath TEXT UNIQUE, "
+            + "size INTEGER, mtime REAL, hash TEXT)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS paragraphs ("
+            + "id INTEGER PRIMARY KEY, file_id INTEGER, chapter TEXT, "
+            + "number INTEGER)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS postings ("
+            + "term TEXT, paragraph_id INTEGER, positions TEXT)")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS paragraphs_file "
+            + "ON paragraphs (file_id)")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS postings_term ON postings (term)")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS postings_paragraph "
+            + "ON postings (paragraph_id)")
+
+    def update_file(self, filename, read):
+        """Makes sure the file is current in the index, calling read
+        with the filename to get the paragraphs if it changed. This
+        returns True if the file was indexed again."""
+
+        abs_filename = os.path.abspath(filename)
+        state = mfgames_writing.cache.FileState(abs_filename)
+        entry = self.connection.execute(
+            "SELECT id, size, mtime, hash FROM files WHERE abspath = ?",
+            (abs_filename,)).fetchone()
+
+        if entry and state.is_unchanged(entry[1:]):
+            return False
+
+        if entry and state.is_same(entry[1:]):
+            self.connection.execute(
+                "UPDATE files SET size = ?, mtime = ? WHERE id = ?",
+                (state.size, state.mtime, entry[0]))
+            return False
+
+        # Read the file before changing anything, so a file that can't
+        # be read keeps what we had for it.
+        paragraphs = read(abs_filename)
+
+        # Replace everything we had for the file. The file isn't marked
+        # as indexed until all of its paragraphs are added.
+        if entry:
+            self.remove_file(entry[0])
+
+        file_id = self.connection.execute(
+            "INSERT INTO files (abspath) VALUES (?)",
+            (abs_filename,)).lastrowid
+
+        for chapter, number, text in paragraphs:
+            paragraph_id = self.connection.execute(
+                "INSERT INTO paragraphs (file_id, chapter, number) "
+                + "VALUES (?, ?, ?)",
+                (file_id, chapter, number)).lastrowid
+
+            positions = {}
+
+            for position, term in enumerate(get_terms(text)):
+                positions.setdefault(term, []).append(str(position))
+
+            self.connection.executemany(
+                "INSERT INTO postings VALUES (?, ?, ?)",
+                [(term, paragraph_id, " ".join(positions[term]))
+                 for term in positions])
+
+        self.connection.execute(
+            "UPDATE files SET size = ?, mtime = ?, hash = ? WHERE id = ?",
+            tuple(state.get_entry()) + (file_id,))
+        return True
+
+    def remove_file(self, file_id):
+        """Removes a file and all of its paragraphs from the index."""
+
+        self.connection.execute(
+            "DELETE FROM postings WHERE paragraph_id IN "
+            + "(SELECT id FROM paragraphs WHERE file_id = ?)",
+            (file_id,))
+        self.connection.execute(
+            "DELETE FROM paragraphs WHERE file_id = ?",
+            (file_id,))
+        self.connection.execute(
+            "DELETE FROM files WHERE id = ?",
+            (file_id,))
+
+    def prune(self):
+        """Removes the files that no longer exist and returns their
+        names."""
+
+        missing = [
+            (file_id, abspath)
+            for file_id, abspath in self.connection.execute(
+                "SELECT id, abspath FROM files").fetchall()
+            if not os.path.isfile(abspath)]
+
+        for file_id, abspath in missing:
+            self.remove_file(file_id)
+
+        return [abspath for file_id, abspath in missing]
+
+    def find_phrase(self, terms):
+        """Finds the paragraphs that have the terms next to each
+        other, in order. This returns a set of paragraph identifiers."""
+
+        # Keep track of where the phrase could start in each paragraph
+        # and narrow it down with each term.
+        starts = None
+
+        for offset, term in enumerate(terms):
+            found = {}
+
+            for paragraph_id, positions in self.connection.execute(
+                "SELECT paragraph_id, positions FROM postings WHERE term = ?",
+                (term,)):
+                if starts is not None and paragraph_id not in starts:
+                    continue
+
+                found[paragraph_id] = set([
+                    int(position) - offset
+                    for position in positions.split()])
+
+            if starts is not None:
+                for paragraph_id in found.keys():
+                    found[paragraph_id] &= starts[paragraph_id]
+
+                    if not found[paragraph_id]:
+                        del found[paragraph_id]
+
+            starts = found
+
+            if not starts:
+                break
+
+        return set(starts or {})
+
+    def search(self, queries):
+        """Finds the paragraphs that match all of the queries, where
+        each query is a single term or a phrase. This returns a list of
+        the absolute path, chapter, and paragraph number."""
+
+        paragraph_ids = None
+
+        for query in queries:
+            terms = get_terms(query)
+
+            if not terms:
+                continue
+
+            found = self.find_phrase(terms)
+
+            if paragraph_ids is None:
+                paragraph_ids = found
+            else:
+                paragraph_ids &= found
+
+            if not paragraph_ids:
+                return []
+
+        if not paragraph_ids:
+            return []
+
+        # Look up where the paragraphs are, a block at a time to stay
+        # under the limit of SQLite parameters.
+        results = []
+        paragraph_ids = sorted(paragraph_ids)
+
+        for index in range(0, len(paragraph_ids), 500):
+            block = paragraph_ids[index:index + 500]
+            results.extend(self.connection.execute(
+                "SELECT files.abspath, paragraphs.id, paragraphs.chapter, "
+                + "paragraphs.number FROM paragraphs JOIN files "
+                + "ON files.id = paragraphs.file_id WHERE paragraphs.id IN ("
+                + ", ".join(["?"] * len(block)) + ")",
+                block).fetchall())
+
+        results.sort()
+        return [
+            (abspath, chapter, number)
+            for abspath, paragraph_id, chapter, number in results]
+
+    def close(self, commit=True):
+        """Writes out any changes and closes the index. If commit is
+        False, then the changes are thrown away instead."""
+
+        if commit:
+            self.connection.commit()
+        else:
+            self.connection.rollback()
+
+        self.connection.close()
+
+
+def _add_index_argument(parser):
+    """Adds the argument for the location of the search index."""
+
+    parser.add_argument(
+        '--index-file',
+        metavar='FILE',
+        type=str,
+        help="The file that contains the search index. If not set, then "
+            + "a file in the user's cache directory is used.")
+
+
+class IndexProcess(mfgames_tools.process.InputFilesProcess):
+    """Adds DocBook files to the full-text search index."""
+
+    def __init__(self):
+        super(IndexProcess, self).__init__()
+        self.log = logging.getLogger('index')
+
+    def get_help(self):
+        return "Adds DocBook files to the full-text search index."
+
+    def process(self, args):
+        args.search_index = SearchIndex(args.index_file)
+
+        try:
+            # Call the parent class' implementation which ensures all
+            # the files exists and indexes each one.
+            super(IndexProcess, self).process(args)
+
+            if args.prune:
+                for abspath in args.search_index.prune():
+                    self.log.info("Removed missing file: " + abspath)
+        except:
+            # Don't keep a partial index if something went wrong or we
+            # were interrupted.
+            args.search_index.close(False)
+            raise
+
+        args.search_index.close()
+
+    def process_file(self, filename):
+        """Indexes a single file, if it has changed."""
+
+        if self.args.search_index.update_file(filename, self.read_file):
+            self.log.info("Indexed file: " + filename)
+
+    def read_file(self, filename):
+        """Reads the paragraphs of the file."""
+
+        # Only the SAX backend sees all of the text inside of a
+        # paragraph, including the inline elements and footnotes.
+        scanner = _IndexScanner(self)
+        scanner.parse(filename, 'sax')
+        return scanner.paragraphs
+
+    def setup_arguments(self, parser):
+        """Sets up the command-line arguments for indexing."""
+
+        # Add in the argument from the base class.
+        super(IndexProcess, self).setup_arguments(parser)
+
+        _add_index_argument(parser)
+        parser.add_argument(
+            '--prune',
+            default=False,
+            action='store_true',
+            help="If set, then files that no longer exist are removed "
+                + "from the index.")
+
+
+class SearchProcess(mfgames_tools.process.Process):
+    """Searches the full-text index for words and phrases."""
+
+    def __init__(self):
+        super(SearchProcess, self).__init__()
+
+    def get_help(self):
+        return "Searches the full-text index for words and phrases."
+
+    def process(self, args):
+        super(SearchProcess, self).process(args)
+
+        index = SearchIndex(args.index_file)
+
+        try:
+            queries = [query.decode('utf-8') for query in args.queries]
+            results = index.search(queries)
+        finally:
+            index.close()
+
+        # Write out the results, either every paragraph or just the
+        # files that have them.
+        shown = set()
+
+        for abspath, chapter, number in results:
+            if args.files_only:
+                if abspath not in shown:
+                    shown.add(abspath)
+                    print abspath
+            else:
+                print u"{0}\t{1}\t{2}".format(abspath, chapter, number)
+
+    def setup_arguments(self, parser):
+        """Sets up the command-line arguments for searching."""
+
+        # Add in the argument from the base class.
+        super(SearchProcess, self).setup_arguments(parser)
+
+        _add_index_argument(parser)
+        parser.add_argument(
+            '--files-only', '-l',
+            default=False,
+            action='store_true',
+            help="If set, then only the files with matches are shown.")
+        parser.add_argument(
+            'queries',
+            metavar='QUERY',
+            type=str,
+            nargs='+',
+            help="The words to search for. A query with more than one "
+                + "word is a phrase. Every query must be in the same "
+                + "paragraph.")
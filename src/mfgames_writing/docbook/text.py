@@ -2,9 +2,9 @@
 
 
 import abc
-import codecs
 import logging
 import mfgames_writing.docbook.scan
+import mfgames_writing.stream
 import os
 import re
 import textwrap
@@ -118,10 +118,8 @@ class ConvertToTextFilesProcess(
 
                 # Open a new output file and keep the handle.
                 self.buffer = unicode()
-                self.output = codecs.open(
-                    self.structure_entry.output_filename,
-                    'w',
-                    'utf-8')
+                self.output = mfgames_writing.stream.open_utf8(
+                    self.structure_entry.output_filename)
                 self.structure_output = self.structure_entry
 
             # Write out the structure header.
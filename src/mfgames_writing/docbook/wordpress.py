@@ -2,18 +2,238 @@
 
 
 import codecs
+import collections
 import datetime
+import hashlib
+import itertools
 import logging
 import lxml.etree
 import mfgames_tools.process
+import mfgames_writing.cache
 import mfgames_writing.docbook.info
+import multiprocessing.pool
 import os
 import re
 import sys
+import threading
 import time
-import xml
+import xml.parsers.expat
 import xmlrpclib
 
+# The first call to strptime imports this module, which isn't safe to
+# do from more than one thread at a time, so import it up front.
+import _strptime
+
+
+def _get_site_key(url, blog):
+    """Gets a short key for the site, used to name its cache files."""
+
+    key = u"{0}\n{1}".format(url, blog).encode('utf-8')
+    return hashlib.sha1(key).hexdigest()[:16]
+
+
+class _SiteCache(object):
+    """Stores what we know about a WordPress site between runs.
+
+    Each site has its own file, based on the XML-RPC URL and blog. The
+    data is written with the XML-RPC marshalling so the values, such as
+    dates, come back the same as they were downloaded.
+    """
+
+    def __init__(self, filename, url, blog):
+        if not filename:
+            filename = mfgames_writing.cache.get_cache_filename(
+                'wordpress-' + _get_site_key(url, blog) + '.xml')
+
+        self.filename = filename
+
+    def load(self):
+        """Loads the site data, or an empty dictionary if there isn't
+        any or it can't be read."""
+
+        try:
+            stream = open(self.filename, 'rb')
+
+            try:
+                params, method = xmlrpclib.loads(stream.read())
+                return params[0]
+            finally:
+                stream.close()
+        except (IOError, xmlrpclib.Error, xml.parsers.expat.ExpatError):
+            return {}
+
+    def save(self, site):
+        """Writes out the site data."""
+
+        mfgames_writing.cache.save_file(
+            self.filename,
+            xmlrpclib.dumps((site,), allow_none=True))
+
+
+class _UploadJournal(object):
+    """Remembers the hash of each file when it was last uploaded.
+
+    A file is known to be uploaded if its size and modification time
+    are the same as when it was uploaded. If they changed, then the
+    file is hashed and compared against the uploaded hash. This lets
+    unchanged files be skipped without talking to the server.
+    """
+
+    def __init__(self, filename, url, blog):
+        if not filename:
+            filename = mfgames_writing.cache.get_cache_filename(
+                'wordpress-' + _get_site_key(url, blog) + '.json')
+
+        self.filename = filename
+        self.entries = mfgames_writing.cache.load_json(filename, {})
+        self.changed = False
+        self.lock = threading.Lock()
+
+    def is_uploaded(self, rel_filename, filename):
+        """Determines if the file is the same as when it was last
+        uploaded to the given page."""
+
+        state = mfgames_writing.cache.FileState(filename)
+
+        with self.lock:
+            entry = self.entries.get(rel_filename)
+
+        if state.is_unchanged(entry):
+            return True
+
+        if not state.is_same(entry):
+            return False
+
+        self.add(rel_filename, filename, state.get_hash())
+        return True
+
+    def add(self, rel_filename, filename, file_hash):
+        """Records that the file was uploaded with the given hash."""
+
+        state = mfgames_writing.cache.FileState(filename)
+        state.hash = file_hash
+
+        with self.lock:
+            self.entries[rel_filename] = state.get_entry()
+            self.changed = True
+
+    def save(self):
+        """Writes out the journal if anything has changed."""
+
+        with self.lock:
+            if self.changed:
+                mfgames_writing.cache.save_json(self.filename, self.entries)
+                self.changed = False
+
+
+def _create_proxy(url, compress=False):
+    """Creates a proxy for the site.
+
+    The transport keeps its connection open between calls and accepts
+    compressed responses. Since a transport only has one connection,
+    each thread needs its own proxy. If compress is set, then larger
+    requests are also compressed, which not every server supports.
+    """
+
+    if url.startswith("https:"):
+        transport = xmlrpclib.SafeTransport()
+    else:
+        transport = xmlrpclib.Transport()
+
+    if compress:
+        transport.encode_threshold = 1400
+
+    return xmlrpclib.ServerProxy(url, transport=transport)
+
+
+def _get_title(info):
+    """Retrieves the formatted title of the piece."""
+
+    title = mfgames_writing.docbook.info._get_element_value(
+        info, "title", "Unknown")
+    subtitle = mfgames_writing.docbook.info._get_element_value(
+        info, "subtitle", None)
+
+    if subtitle:
+        title += ": " + subtitle
+
+    return title
+
+
+def _get_subjectsets(info):
+    """Retrieves the terms of each subjectset as a list of the schema
+    and its terms, in the order they appear."""
+
+    ns = mfgames_writing.docbook.info.docbook_lxml_ns
+    subjectsets = []
+
+    for subjectset in info.getiterator(ns + "subjectset"):
+        terms = []
+
+        for subject in subjectset.getiterator(ns + "subject"):
+            for subjectterm in subject.getiterator(ns + "subjectterm"):
+                terms.append(subjectterm.text)
+
+        subjectsets.append((subjectset.attrib['schema'], terms))
+
+    return subjectsets
+
+
+def _get_content(xml, transform):
+    """Format and retrieves the contents of the piece."""
+
+    # Process the results of the document.
+    results = transform(xml)
+    xml_ns = mfgames_writing.docbook.info.xml_ns
+
+    for div in results.xpath("/*", namespaces=xml_ns):
+        contents = lxml.etree.tostring(div)
+        contents = re.sub(r'^<div.*?>', '', contents)
+        contents = re.sub(r'\s*</div>.*?$', '', contents, re.S)
+        return contents
+
+    # If we got this far, we don't know what to do.
+    return None
+
+
+def _render_page(xml, transform):
+    """Pulls out everything needed for a page from the parsed file.
+
+    This only uses plain values so it can be sent between processes.
+    The subjectsets are mapped to the site's taxonomies afterwards.
+    """
+
+    # Pull out the <info/> element.
+    info = mfgames_writing.docbook.info._get_element_node(xml, "info", None)
+
+    return {
+        'title': _get_title(info),
+        'date': mfgames_writing.docbook.info._get_element_value(
+            info, "date", None),
+        'subjectsets': _get_subjectsets(info),
+        'content': _get_content(xml, transform),
+        }
+
+
+# The stylesheet for a rendering process, compiled when it starts.
+_render_transform = None
+
+
+def _init_render_worker(xslt_filename):
+    """Compiles the stylesheet for a rendering process."""
+
+    global _render_transform
+    _render_transform = lxml.etree.XSLT(lxml.etree.parse(xslt_filename))
+
+
+def _render_file(filename):
+    """Renders a file inside a rendering process."""
+
+    try:
+        return _render_page(lxml.etree.parse(filename), _render_transform)
+    except Exception as e:
+        raise mfgames_writing.docbook.info._get_worker_error(filename, e)
+
 
 class UploadFilesProcess(mfgames_tools.process.InputFilesProcess):
     """Uploads files to a WordPress site, updating or adding pages as
@@ -27,6 +247,22 @@ class UploadFilesProcess(mfgames_tools.process.InputFilesProcess):
         self.taxonomies = {}
         self.taxonomies_cached = []
 
+        # We assume the server supports multicall until it fails.
+        self.use_multicall = True
+
+        # What we know about the site from the last run.
+        self.site = {}
+        self.taxonomies_refreshed = False
+
+        # The files waiting to be uploaded in parallel and the proxy
+        # and stylesheet for each of the threads doing it.
+        self.pending = []
+        self.local = threading.local()
+
+        # The site is only loaded once a file needs to be uploaded.
+        self.site_loaded = False
+        self.site_lock = threading.Lock()
+
     def get_help(self):
         return "Uploads files to a WordPress site."
 
@@ -42,20 +278,184 @@ class UploadFilesProcess(mfgames_tools.process.InputFilesProcess):
         self.transform = lxml.etree.XSLT(xslt)
 
         # Set up the XMLRPC proxy for this site.
-        self.proxy = xmlrpclib.ServerProxy(self.args.url)
+        self.proxy = _create_proxy(self.args.url, self.args.compress)
+        self.local.proxy = self.proxy
+        self.local.transform = self.transform
+
+        # Load the hashes of the files we uploaded on the last run.
+        self.journal = None
 
-        # Retrieve all the pages on the website.
-        self.get_options()
-        self.cache_pages()
-        self.cache_taxonomies()
+        if not self.args.no_upload_journal:
+            self.journal = _UploadJournal(
+                self.args.upload_journal_file,
+                self.args.url,
+                self.args.blog)
 
         # Call the base implementation which will also process each
-        # file.
-        super(UploadFilesProcess, self).pre_process_file()
+        # file. If we have multiple jobs, this only collects them.
+        try:
+            super(UploadFilesProcess, self).pre_process_file()
+
+            if self.pending:
+                self.upload_pending()
+        finally:
+            if self.journal:
+                self.journal.save()
+
+    def load_site(self):
+        """Retrieves the options, pages, and taxonomies of the site,
+        if they haven't been already."""
+
+        with self.site_lock:
+            if self.site_loaded:
+                return
+
+            # Load what we downloaded from the site on the last run.
+            self.site_cache = None
+
+            if not self.args.no_site_cache:
+                self.site_cache = _SiteCache(
+                    self.args.site_cache_file,
+                    self.args.url,
+                    self.args.blog)
+
+                if not self.args.refresh_site_cache:
+                    self.site = self.site_cache.load()
+
+            # Retrieve all the pages on the website, or at least the
+            # ones that changed since the last run.
+            self.get_options()
+            self.cache_pages()
+            self.cache_taxonomies()
+
+            if self.site_cache:
+                self.site_cache.save(self.site)
+
+            self.site_loaded = True
 
     def process_file(self, filename):
-        # Parse the file as an XML object so we can pull out elements.
-        xml = lxml.etree.parse(filename)
+        # If the file hasn't changed since we uploaded it, we don't
+        # need to look at the server at all.
+        rel_filename = self.get_rel_filename(filename)
+
+        if (self.journal
+            and not self.args.force
+            and self.journal.is_uploaded(rel_filename, filename)):
+            self.log.info("Skipping because of journal: " + rel_filename)
+            return
+
+        # If we are uploading in parallel, the file is uploaded later.
+        if self.args.jobs > 1 or self.args.render_jobs > 0:
+            self.pending.append(filename)
+            return
+
+        self.upload_file(filename)
+
+    def upload_pending(self):
+        """Uploads the collected files in parallel.
+
+        A new page needs its parent to already exist, so the files are
+        uploaded in waves by how deep they are in the site. Every file
+        in a wave is finished before the next wave starts.
+
+        If there are rendering jobs, then the files are parsed and
+        transformed by a pool of processes while the threads send the
+        pages that are already rendered.
+        """
+
+        def get_depth(filename):
+            return len(self.get_rel_filename(filename).split(os.path.sep))
+
+        files = sorted(self.pending, key=get_depth)
+        pool = None
+        render_pool = None
+
+        # The rendering processes are forked from this one, so start
+        # them before there are any threads or connections to the site.
+        if self.args.render_jobs > 0:
+            render_pool = multiprocessing.Pool(
+                self.args.render_jobs,
+                _init_render_worker,
+                (self.args.xslt,))
+
+        try:
+            # Load the site before starting the threads, so only the
+            # main thread uses the shared proxy.
+            self.load_site()
+            pool = multiprocessing.pool.ThreadPool(max(1, self.args.jobs))
+
+            if render_pool:
+                self.render_pending(files, get_depth, pool, render_pool)
+            else:
+                for depth, wave in itertools.groupby(files, get_depth):
+                    pool.map(self.upload_file, list(wave), 1)
+        except:
+            # Don't render or send anything else once something failed.
+            for running_pool in [pool, render_pool]:
+                if running_pool:
+                    running_pool.terminate()
+
+            raise
+        else:
+            for running_pool in [pool, render_pool]:
+                if running_pool:
+                    running_pool.close()
+        finally:
+            for running_pool in [pool, render_pool]:
+                if running_pool:
+                    running_pool.join()
+
+    def render_pending(self, files, get_depth, pool, render_pool):
+        """Renders the files that need to be uploaded with the process
+        pool while sending the rendered pages with the threads."""
+
+        # Only render the files that don't match their pages.
+        uploads = filter(None, [self.get_upload(f) for f in files])
+        pages = render_pool.imap(
+            _render_file,
+            [upload[0] for upload in uploads])
+
+        # Send each page as it is rendered, waiting for the previous
+        # wave to finish when we get deeper into the site.
+        sending = []
+        current_depth = None
+
+        for upload, page in itertools.izip(uploads, pages):
+            depth = get_depth(upload[0])
+
+            if depth != current_depth:
+                for result in sending:
+                    result.get()
+
+                sending = []
+                current_depth = depth
+
+            sending.append(pool.apply_async(self.send_page, (upload, page)))
+
+        for result in sending:
+            result.get()
+
+    def get_proxy(self):
+        """Gets the proxy for the current thread."""
+
+        if not hasattr(self.local, 'proxy'):
+            self.local.proxy = _create_proxy(
+                self.args.url,
+                self.args.compress)
+
+        return self.local.proxy
+
+    def get_transform(self):
+        """Gets the stylesheet for the current thread."""
+
+        if not hasattr(self.local, 'transform'):
+            self.local.transform = lxml.etree.XSLT(
+                lxml.etree.parse(self.args.xslt))
+
+        return self.local.transform
+
+    def get_rel_filename(self, filename):
+        """Gets the path of the file inside the WordPress site."""
 
         # Strip off the common part of the root directory from the
         # filename, since this is the relative path inside the
@@ -70,44 +470,80 @@ class UploadFilesProcess(mfgames_tools.process.InputFilesProcess):
         # Get the relative filename for the WordPress site.
         rel_filename = abs_filename.replace(abs_root_directory, "")
         rel_filename = rel_filename.replace(".xml", "")
+        return rel_filename
+
+    def upload_file(self, filename):
+        """Creates or updates the page for a single file."""
+
+        upload = self.get_upload(filename)
+
+        if upload:
+            xml = lxml.etree.parse(filename)
+            self.send_page(upload, _render_page(xml, self.get_transform()))
+
+    def get_upload(self, filename):
+        """Determines if the file needs to be uploaded. If it does,
+        this returns the filename, relative filename, hash, and the
+        current page (if there is one). Otherwise, this returns None."""
+
+        # Make sure we know what is on the server.
+        self.load_site()
 
-        # Get the hash of the file to determine if we need to change it.
+        # Get the relative filename for the WordPress site.
+        rel_filename = self.get_rel_filename(filename)
+
+        # Get the hash of the file to determine if we need to change
+        # it. This is checked before parsing the file, since most
+        # pages don't change between runs.
         file_hash = mfgames_writing.get_file_hash(filename)
+        post = self.pages.get(rel_filename)
+
+        if (post
+            and not self.args.force
+            and self.get_page_hash(post) == file_hash):
+            self.log.info("Skipping because of hash: " + rel_filename)
+            self.add_upload(rel_filename, filename, file_hash)
+            return None
+
+        return (filename, rel_filename, file_hash, post)
+
+    def send_page(self, upload, page):
+        """Sends a rendered page to the server."""
+
+        filename, rel_filename, file_hash, post = upload
 
         # Figure out if the page exists already.
-        if rel_filename in self.pages:
-            self.update_page(
-                filename, 
-                rel_filename, 
-                xml, 
-                self.pages[rel_filename],
-                file_hash)
+        if post:
+            self.update_page(filename, rel_filename, page, post, file_hash)
         else:
-            self.create_page(filename, rel_filename, xml, file_hash)
-
-    def update_page(self, filename, rel_filename, xml, post, file_hash):
-        # Pull out some useful variables.
-        post = self.pages[rel_filename]
-        post_id = post['post_id']
+            self.create_page(filename, rel_filename, page, file_hash)
 
-        # Check to see if the custom fields exists and if it matches.
-        custom_fields = post['custom_fields']
+    def get_page_hash(self, post):
+        """Gets the hash of the file that was uploaded to the page, or
+        None if it doesn't have one."""
 
-        for custom_field in custom_fields:
+        for custom_field in post['custom_fields']:
             if custom_field['key'] == "mfgames-docbook-sha256":
-                # If the value is the same, we don't change it.
-                if not self.args.force and custom_field['value'] == file_hash:
-                    self.log.info("Skipping because of hash: " + rel_filename)
-                    return
+                return custom_field['value']
 
-                # Break out since we found what we're looking for.
-                break
+        return None
+
+    def add_upload(self, rel_filename, filename, file_hash):
+        """Records that the page has the current version of the file."""
+
+        if self.journal:
+            self.journal.add(rel_filename, filename, file_hash)
+
+    def update_page(self, filename, rel_filename, page, post, file_hash):
+        # Pull out some useful variables.
+        post_id = post['post_id']
+        custom_fields = post['custom_fields']
 
         # Report that we're creating a page.
         self.log.info("Updating page: " + rel_filename)
 
         # Create the content element for this page.
-        content = self.get_wp_content(xml)
+        content = self.get_wp_content(page)
 
         # Add in the custom fields for the hash field.
         content['custom_fields'] = custom_fields
@@ -126,14 +562,15 @@ class UploadFilesProcess(mfgames_tools.process.InputFilesProcess):
                     })
 
         # Create the page on the server.
-        self.proxy.wp.editPost(
+        self.get_proxy().wp.editPost(
             self.args.blog,
             self.args.username,
             self.args.password,
             post_id,
             content)
+        self.add_upload(rel_filename, filename, file_hash)
 
-    def create_page(self, filename, rel_filename, xml, file_hash):
+    def create_page(self, filename, rel_filename, page, file_hash):
         # Report that we're creating a page.
         self.log.info("Creating page: " + rel_filename)
 
@@ -149,7 +586,7 @@ class UploadFilesProcess(mfgames_tools.process.InputFilesProcess):
             return
 
         # Create the content element for this page.
-        content = self.get_wp_content(xml)
+        content = self.get_wp_content(page)
         content['post_name'] = slugs[-1]
         content['post_parent'] = self.pages[parent_path]['post_id']
 
@@ -160,39 +597,37 @@ class UploadFilesProcess(mfgames_tools.process.InputFilesProcess):
         content['custom_fields'] = custom_fields
 
         # Create the page on the server.
-        post_id = self.proxy.wp.newPost(
+        post_id = self.get_proxy().wp.newPost(
             self.args.blog,
             self.args.username,
             self.args.password,
             content)
 
         # Download the page and add it into the list.
-        post = self.proxy.wp.getPost(
+        post = self.get_proxy().wp.getPost(
             self.args.blog,
             self.args.username,
             self.args.password,
             post_id)
         self.pages[rel_filename] = post
+        self.add_upload(rel_filename, filename, file_hash)
 
-    def get_wp_content(self, xml):
-        # Pull out the <info/> element.
-        info = mfgames_writing.docbook.info._get_element_node(xml, "info", None)
-
-        # If we got this far, we have to create the elements of the page.
-        taxonomies = self.get_taxonomies(info)
+    def get_wp_content(self, page):
+        # Map the subjectsets into the taxonomies of the site.
+        taxonomies = self.get_taxonomies(page['subjectsets'])
 
         content = {
             'post_type': 'page',
             'post_status': 'publish',
-            'post_title': self.get_title(info),
+            'post_title': page['title'],
             'post_except': '',
-            'post_content': self.get_content(xml),
+            'post_content': page['content'],
             'terms_names': taxonomies,
             'comment_status': self.args.comments,
             }
 
         # Add the date, if we have one.
-        date = self.get_date(info)
+        date = self.get_date(page['date'])
 
         if date:
             content['post_date_gmt'] = date
@@ -200,20 +635,21 @@ class UploadFilesProcess(mfgames_tools.process.InputFilesProcess):
         # Return the resulting content object.
         return content
 
-    def get_taxonomies(self, info):
+    def get_taxonomies(self, subjectsets):
         """Retrieves the custom taxonomies for the piece."""
 
-        ns = mfgames_writing.docbook.info.docbook_lxml_ns
-        subjectsets = {}
-
-        for subjectset in info.getiterator(ns + "subjectset"):
-            # Using the schema name, pull out the taxonomy.
-            schema = subjectset.attrib['schema']
+        taxonomies = {}
 
+        for schema, subjectset_terms in subjectsets:
             # Check to see if we are excluding the taxonomies.
             if schema in self.args.exclude_taxonomy:
                 continue
 
+            # The taxonomies may have come from the last run, so make
+            # sure it wasn't added since then.
+            if not schema in self.taxonomies:
+                self.refresh_taxonomies(schema)
+
             # If we are including it and we can't find it, then report
             # it to the user.
             if not schema in self.taxonomies:
@@ -222,60 +658,40 @@ class UploadFilesProcess(mfgames_tools.process.InputFilesProcess):
                                
             taxonomy_name = self.taxonomies[schema]['name']
 
-            # Go through the child terms and build up a list of them.
+            # Add the terms to any we already have for the taxonomy.
             terms = []
 
-            if taxonomy_name in subjectsets:
-                terms = subjectsets[taxonomy_name]
+            if taxonomy_name in taxonomies:
+                terms = taxonomies[taxonomy_name]
+
+            terms.extend(subjectset_terms)
 
-            for subject in subjectset.getiterator(ns + "subject"):
-                for subjectterm in subject.getiterator(ns + "subjectterm"):
-                    term = subjectterm.text
-                    terms.append(term)
-            
             # Save the terms into the schema.
-            subjectsets[taxonomy_name] = terms
+            taxonomies[taxonomy_name] = terms
 
         # Return the resulting terms.
-        return subjectsets
-
-    def get_content(self, xml):
-        """Format and retrieves the contents of the piece."""
+        return taxonomies
 
-        # Process the results of the document.
-        results = self.transform(xml)
-        ns = mfgames_writing.docbook.info.docbook_lxml_ns
-        xml_ns = mfgames_writing.docbook.info.xml_ns
-
-        for div in results.xpath("/*", namespaces=xml_ns):
-            contents = lxml.etree.tostring(div)
-            contents = re.sub(r'^<div.*?>', '', contents)
-            contents = re.sub(r'\s*</div>.*?$', '', contents, re.S)
-            return contents
-
-        # If we got this far, we don't know what to do.
-        return None
+    def refresh_taxonomies(self, schema):
+        """Downloads the taxonomies again if they came from the last
+        run, since the schema may have been added since then. This is
+        called from the upload threads, so only one does it."""
 
-    def get_title(self, info):
-        """Retrieves the formatted title of the piece."""
+        with self.site_lock:
+            if schema in self.taxonomies or self.taxonomies_refreshed:
+                return
 
-        title = mfgames_writing.docbook.info._get_element_value(
-            info, "title", "Unknown")
-        subtitle = mfgames_writing.docbook.info._get_element_value(
-            info, "subtitle", None)
+            self.log.info("Refreshing taxonomies for: " + schema)
+            self.site.pop('taxonomies', None)
+            self.cache_taxonomies()
 
-        if subtitle:
-            title += ": " + subtitle
-        
-        return title
+            if self.site_cache:
+                self.site_cache.save(self.site)
 
-    def get_date(self, info):
+    def get_date(self, date):
         """Retrieves the formatted date of the piece."""
 
-        # Pull out the date field. If we don't have one, return none.
-        date = mfgames_writing.docbook.info._get_element_value(
-            info, "date", None)
-
+        # If we don't have a date field, return none.
         if not date:
             return None
 
@@ -287,12 +703,15 @@ class UploadFilesProcess(mfgames_tools.process.InputFilesProcess):
     def get_options(self):
         """Retrieves a list of options from the server."""
 
-        self.log.info("Getting options from the server")
-
-        self.options = self.proxy.wp.getOptions(
-            self.args.blog,
-            self.args.username,
-            self.args.password)
+        if 'options' in self.site:
+            self.options = self.site['options']
+        else:
+            self.log.info("Getting options from the server")
+            self.options = self.proxy.wp.getOptions(
+                self.args.blog,
+                self.args.username,
+                self.args.password)
+            self.site['options'] = self.options
 
         # Break out some useful elements.
         self.blog_url = self.options['blog_url']['value']
@@ -301,77 +720,193 @@ class UploadFilesProcess(mfgames_tools.process.InputFilesProcess):
     def cache_taxonomies(self):
         """Downloads the master list of taxonomies from the server."""
 
-        # Report what we're doing.
-        self.log.debug("Downloading taxonomies")
+        # We need to cache the basic taxonomy information, but we
+        # only download it if we don't have it from the last run.
+        if 'taxonomies' in self.site:
+            taxonomies = self.site['taxonomies']
+        else:
+            self.log.debug("Downloading taxonomies")
+            taxonomies = self.get_proxy().wp.getTaxonomies(
+                self.args.blog,
+                self.args.username,
+                self.args.password)
+            self.site['taxonomies'] = taxonomies
+            self.taxonomies_refreshed = True
 
-        # We need to cache the basic taxonomy information.
-        taxonomies = self.proxy.wp.getTaxonomies(
-            self.args.blog,
-            self.args.username,
-            self.args.password)
+        # Build up the new list before replacing the old one, since the
+        # upload threads may be using it.
+        taxonomies_by_name = {}
 
         for taxonomy in taxonomies:
             # Add in the stubs for the terms.
+            taxonomy = dict(taxonomy)
             taxonomy['terms'] = {}
 
             # Get the name so we can save it.
             taxonomy_name = taxonomy['labels']['singular_name']
-            self.taxonomies[taxonomy_name] = taxonomy
+            taxonomies_by_name[taxonomy_name] = taxonomy
+
+        self.taxonomies = taxonomies_by_name
 
     def cache_pages(self):
         """Downloads a list of pages from the server so it can be cached."""
 
         # First start by retrieving the list of pages from the
         # server. We do that because with sites that have a lot of
-        # pages, we can overload the server too easily.
+        # pages, we can overload the server too easily. If we can, we
+        # get when each page was modified so we only have to download
+        # the ones that changed since the last run.
         self.log.info("Downloading page list from server")
 
-        pages = self.proxy.wp.getPageList(
-            self.args.blog,
-            self.args.username,
-            self.args.password)
+        modified = self.list_pages()
+
+        if modified is None:
+            # We can't tell what changed, so download everything.
+            pages = self.proxy.wp.getPageList(
+                self.args.blog,
+                self.args.username,
+                self.args.password)
+            page_ids = [str(page['page_id']) for page in pages]
+            cached = {}
+            modified = {}
+        else:
+            page_ids = modified.keys()
+            cached = self.site.get('pages', {})
 
-        self.log.info("Processing {0:n} pages".format(len(pages)))
+        # Figure out which pages we need from the server.
+        pages = {}
+        download_ids = []
 
-        # Go through each post and retrieve it from the server.
-        self.pages = {}
+        for page_id in page_ids:
+            entry = cached.get(page_id)
 
-        next_report = int(time.time()) + 5
-        processed = 0
+            if entry and entry['modified'] == modified[page_id]:
+                pages[page_id] = entry['data']
+            else:
+                download_ids.append(page_id)
 
-        for page in pages:
-            # Pull out information about the page.
-            page_id = page['page_id']
-            page_title = page['page_title']
+        self.log.info("Processing {0:n} pages, {1:n} changed".format(
+            len(page_ids),
+            len(download_ids)))
 
-            # Get the full page data
-            data = self.proxy.wp.getPage(
-                self.args.blog,
-                page_id,
-                self.args.username,
-                self.args.password);
-            data['post_id'] = page_id
+        # Go through each changed post and retrieve it from the
+        # server. This is done in batches to avoid a round trip for
+        # every page.
+        next_report = int(time.time()) + 5
+        processed = 0
+        batch_size = max(1, self.args.page_batch_size)
 
-            # Store the information about the page using the relative
-            # link (without the blog_url).
-            rel_link = data['link'].replace(self.blog_url, "")[1:]
-            rel_link = re.sub(r'/$', "", rel_link)
-            self.pages[rel_link] = data
+        for index in range(0, len(download_ids), batch_size):
+            batch = download_ids[index:index + batch_size]
 
-            # DEBUG self.log.debug("Link {0}".format(rel_link))
+            for page_id, data in zip(batch, self.get_pages(batch)):
+                processed += 1
+                pages[page_id] = data
 
             # Check to see if we need to report our status.
-            processed += 1
-
             if (int(time.time()) > next_report):
                 l = format(len(format(len(pages))))
                 self.log.debug(
                     ("  Processed {2:5.1f}%: {0:" + l + "} of {1}").format(
                         processed,
-                        len(pages),
-                        100.0 * processed / len(pages)))
+                        len(download_ids),
+                        100.0 * processed / len(download_ids)))
                 next_report = time.time() + 60
 
+        # Add the pages into the cache and remember them for the next
+        # run, along with when they were modified.
+        self.pages = {}
+        self.site['pages'] = {}
+
+        for page_id in page_ids:
+            self.add_page(page_id, pages[page_id])
+            self.site['pages'][page_id] = {
+                'modified': modified.get(page_id, ''),
+                'data': pages[page_id],
+                }
+
+    def list_pages(self):
+        """Retrieves when each page on the server was last modified,
+        in the order of the pages, or None if the server can't list
+        them that way."""
+
+        modified = collections.OrderedDict()
+
+        while True:
+            try:
+                posts = self.proxy.wp.getPosts(
+                    self.args.blog,
+                    self.args.username,
+                    self.args.password,
+                    {
+                        'post_type': 'page',
+                        'number': 500,
+                        'offset': len(modified),
+                        'orderby': 'ID',
+                        'order': 'ASC',
+                    },
+                    ['post_id', 'post_modified_gmt'])
+            except xmlrpclib.Fault as e:
+                self.log.warning(
+                    "Cannot list modified pages, downloading all of them: "
+                    + str(e))
+                return None
+
+            if not posts:
+                return modified
+
+            for post in posts:
+                modified[str(post['post_id'])] = str(post['post_modified_gmt'])
+
+    def get_pages(self, page_ids):
+        """Retrieves the full data for the given pages. If there is
+        more than one, they are retrieved with a single multicall
+        unless the server doesn't support it."""
+
+        if len(page_ids) > 1 and self.use_multicall:
+            multicall = xmlrpclib.MultiCall(self.proxy)
+
+            for page_id in page_ids:
+                multicall.wp.getPage(
+                    self.args.blog,
+                    page_id,
+                    self.args.username,
+                    self.args.password)
+
+            # If the multicall itself fails, then fall back to asking
+            # for one page at a time. A fault for a single page is
+            # only raised when we get to that page in the results.
+            try:
+                results = multicall()
+            except (xmlrpclib.Fault, xmlrpclib.ProtocolError) as e:
+                self.log.warning(
+                    "Cannot use system.multicall, using single calls: "
+                    + str(e))
+                self.use_multicall = False
+            else:
+                return list(results)
+
+        return [
+            self.proxy.wp.getPage(
+                self.args.blog,
+                page_id,
+                self.args.username,
+                self.args.password)
+            for page_id in page_ids]
+
+    def add_page(self, page_id, data):
+        """Adds the data for a page to the cache."""
+
+        data['post_id'] = page_id
+
+        # Store the information about the page using the relative link
+        # (without the blog_url).
+        rel_link = data['link'].replace(self.blog_url, "")[1:]
+        rel_link = re.sub(r'/$', "", rel_link)
+        self.pages[rel_link] = data
+
+        # DEBUG self.log.debug("Link {0}".format(rel_link))
+
     def setup_arguments(self, parser):
         # Add in the argument from the base class.
         super(UploadFilesProcess, self).setup_arguments(parser)
@@ -390,6 +925,68 @@ class UploadFilesProcess(mfgames_tools.process.InputFilesProcess):
             '--blog', '-B',
             type=str,
             default="")
+        parser.add_argument(
+            '--page-batch-size',
+            type=int,
+            default=50,
+            help="The number of pages retrieved with each system.multicall "
+                + "request. Use 1 to retrieve one page at a time.")
+        parser.add_argument(
+            '--compress',
+            default=False,
+            action='store_true',
+            help="If set, then larger requests are sent compressed. The "
+                + "server has to support gzip-encoded requests.")
+        parser.add_argument(
+            '--jobs', '-j',
+            type=int,
+            default=1,
+            help="The number of pages uploaded at the same time. Parent "
+                + "pages are always uploaded before their children.")
+        parser.add_argument(
+            '--render-jobs',
+            metavar='N',
+            type=int,
+            default=0,
+            help="The number of processes used to transform the files "
+                + "while the pages are being sent. If 0, then each file is "
+                + "transformed just before it is sent.")
+        parser.add_argument(
+            '--upload-journal',
+            dest='upload_journal_file',
+            metavar='FILE',
+            type=str,
+            help="The file used to remember the hash of each file when it "
+                + "was last uploaded, so unchanged files are skipped "
+                + "without contacting the site. If not set, then a file in "
+                + "the user's cache directory is used.")
+        parser.add_argument(
+            '--no-upload-journal',
+            default=False,
+            action='store_true',
+            help="If set, then every file is checked against the pages on "
+                + "the site. Use this if pages were changed or removed "
+                + "outside of this tool.")
+        parser.add_argument(
+            '--site-cache',
+            dest='site_cache_file',
+            metavar='FILE',
+            type=str,
+            help="The file used to remember the pages, taxonomies, and "
+                + "options of the site between runs. If not set, then a "
+                + "file in the user's cache directory is used.")
+        parser.add_argument(
+            '--no-site-cache',
+            default=False,
+            action='store_true',
+            help="If set, then everything is downloaded from the site and "
+                + "nothing is remembered for the next run.")
+        parser.add_argument(
+            '--refresh-site-cache',
+            default=False,
+            action='store_true',
+            help="If set, then everything is downloaded from the site and "
+                + "remembered for the next run.")
 
         # Post preferences.
         parser.add_argument(
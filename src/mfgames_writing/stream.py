@@ -0,0 +1,53 @@
+"""Contains the buffered output streams used when writing files."""
+
+
+class BufferedWriter(object):
+    """Writes UTF-8 text to a stream in large blocks.
+
+    A codecs writer encodes and writes every time it is called, which
+    is slow when the output is built up from millions of small pieces
+    such as element names and attributes. This collects the pieces
+    and only encodes and writes them once enough text has built up.
+    The bytes written are the same as with a codecs writer.
+    """
+
+    def __init__(self, stream, block_size=2**16):
+        self.stream = stream
+        self.block_size = block_size
+        self.parts = []
+        self.size = 0
+
+    def write(self, text):
+        """Adds the text to the buffer, writing out the buffer if it
+        has gotten large enough."""
+
+        # Byte strings are treated as UTF-8, the same as the codecs
+        # writer does when the default encoding is UTF-8.
+        if isinstance(text, str):
+            text = text.decode('utf-8')
+
+        self.parts.append(text)
+        self.size += len(text)
+
+        if self.size >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        """Writes out everything in the buffer."""
+
+        if self.parts:
+            self.stream.write(u''.join(self.parts).encode('utf-8'))
+            self.parts = []
+            self.size = 0
+
+    def close(self):
+        """Writes out the buffer and closes the underlying stream."""
+
+        self.flush()
+        self.stream.close()
+
+
+def open_utf8(filename):
+    """Opens the given file for writing UTF-8 text without a BOM."""
+
+    return BufferedWriter(open(filename, 'wb'))
@@ -0,0 +1,156 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Measures how long it takes to cache the pages of a WordPress site.
+
+This runs a local XML-RPC server that stands in for WordPress, with a
+small delay on every request to act like a remote server, then caches
+the pages with different batch sizes. It then caches them again using
+the pages from the previous run, after a few have been modified. The
+last run uses a server without system.multicall or wp.getPosts to show
+the fallback to single calls.
+"""
+
+#
+# Imports
+#
+
+# System Imports
+import SimpleXMLRPCServer
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+import xmlrpclib
+
+local_directory = os.path.normpath(os.path.dirname(__file__))
+src_directory = os.path.realpath(local_directory + "/../src")
+
+sys.path.insert(0, src_directory)
+
+import mfgames_writing.docbook.wordpress
+
+#
+# Stand-in Server
+#
+
+BLOG_URL = "http://example.com"
+
+
+class _DelayedRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+    """Waits before handling each request to simulate latency."""
+
+    delay = 0.0
+
+    def do_POST(self):
+        time.sleep(self.delay)
+        SimpleXMLRPCServer.SimpleXMLRPCRequestHandler.do_POST(self)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(pages, delay, multicall, modified):
+    """Starts a stand-in WordPress server on a free port and returns
+    the server and its URL."""
+
+    class handler(_DelayedRequestHandler):
+        pass
+
+    handler.delay = delay
+    server = SimpleXMLRPCServer.SimpleXMLRPCServer(
+        ("127.0.0.1", 0),
+        requestHandler=handler,
+        logRequests=False,
+        allow_none=True)
+
+    def get_page_list(blog, username, password):
+        return [
+            {'page_id': page_id, 'page_title': "Page " + str(page_id)}
+            for page_id in range(pages)]
+
+    def get_page(blog, page_id, username, password):
+        return {
+            'page_id': page_id,
+            'link': BLOG_URL + "/page-" + str(page_id) + "/",
+            'custom_fields': [],
+            }
+
+    def get_posts(blog, username, password, filter, fields):
+        offset = filter['offset']
+        page_ids = range(offset, min(pages, offset + filter['number']))
+        return [
+            {
+                'post_id': str(page_id),
+                'post_modified_gmt': xmlrpclib.DateTime(
+                    modified.get(page_id, 0)),
+            }
+            for page_id in page_ids]
+
+    server.register_function(get_page_list, 'wp.getPageList')
+    server.register_function(get_page, 'wp.getPage')
+
+    if multicall:
+        server.register_multicall_functions()
+        server.register_function(get_posts, 'wp.getPosts')
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server, "http://127.0.0.1:{0}/".format(server.server_address[1])
+
+
+def cache_pages(url, batch_size, site=None):
+    """Caches the pages from the server and returns the number of
+    pages, how long it took, and what would be kept for the next run."""
+
+    process = mfgames_writing.docbook.wordpress.UploadFilesProcess()
+    process.args = argparse.Namespace(
+        blog="",
+        username="user",
+        password="pass",
+        page_batch_size=batch_size)
+    process.log = logging.getLogger('benchmark')
+    process.proxy = xmlrpclib.ServerProxy(url)
+    process.blog_url = BLOG_URL
+    process.site = site or {}
+
+    start = time.time()
+    process.cache_pages()
+    return len(process.pages), time.time() - start, process.site
+
+#
+# Entry
+#
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--pages', type=int, default=1000)
+    parser.add_argument('--delay', type=float, default=0.002)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    modified = {}
+    server, url = start_server(args.pages, args.delay, True, modified)
+
+    for batch_size in [1, 10, 50, 200]:
+        count, elapsed, site = cache_pages(url, batch_size)
+        print "batch {0:4}: {1} pages in {2:.2f}s".format(
+            batch_size, count, elapsed)
+
+    # Modify a few pages and use what we had from the last run.
+    for page_id in range(0, args.pages, 100):
+        modified[page_id] = time.time()
+
+    count, elapsed, site = cache_pages(url, 50, site)
+    print "cached: {0} pages in {1:.2f}s".format(count, elapsed)
+    server.shutdown()
+
+    server, url = start_server(args.pages, args.delay, False, modified)
+    count, elapsed, site = cache_pages(url, 50)
+    print "no multicall: {0} pages in {1:.2f}s".format(count, elapsed)
+    server.shutdown()
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#
+# Imports
+#
+
+# System Imports
+import argparse
+import os
+import sys
+import unittest
+
+local_directory = os.path.normpath(os.path.dirname(__file__))
+src_directory = os.path.realpath(local_directory + "/../src")
+
+sys.path.insert(0, src_directory)
+
+import mfgames_writing.docbook.count
+import mfgames_writing.docbook.depends
+import mfgames_writing.docbook.info
+import mfgames_writing.docbook.scan
+
+#
+# Unit Test
+#
+
+def _get_filename(name):
+    return os.path.join(local_directory, 'docbook', 'backend', name)
+
+
+class BackendTests(unittest.TestCase):
+    """Makes sure the scanners get the same results from every parsing
+    backend. The files have nested paragraphs (footnotes), inline
+    elements inside of text, and includes."""
+
+    def count(self, backend, name='book.xml'):
+        process = mfgames_writing.docbook.count.CountProcess()
+        process.args = argparse.Namespace(
+            columns=mfgames_writing.docbook.count._COLUMNS,
+            context='chapters',
+            follow_xincludes=True,
+            parser=backend)
+        return process.count_file(_get_filename(name))
+
+    def scan(self, backend, name='book.xml'):
+        process = argparse.Namespace(args=argparse.Namespace())
+        scanner = mfgames_writing.docbook.scan._StructureScanner(
+            process,
+            'book.txt')
+        scanner.parse(_get_filename(name), backend)
+        return [
+            (entry.docbook_element, entry.title, entry.number,
+             entry.docbook_id, entry.input_depth, entry.subjectsets)
+            for entry in scanner.entries]
+
+    def depends(self, backend, name):
+        process = mfgames_writing.docbook.depends.DependsFileProcess()
+        process.args = argparse.Namespace(parser=backend)
+        return process.scan_references(_get_filename(name))
+
+    def test_count(self):
+        segments = self.count('sax')
+        self.assertEqual(
+            [None, u'First Chapter', None, u'Included Chapter', None,
+             u'Last Chapter', None],
+            [title for is_chapter, title, record in segments])
+        self.assertEqual(segments, self.count('lxml'))
+
+    def test_scan(self):
+        entries = self.scan('sax')
+        self.assertEqual(
+            [u'Book Title', u'First Chapter', u'Section', u'Last Chapter'],
+            [entry[1] for entry in entries])
+        self.assertEqual(
+            [u'Fantasy', u'Science Fiction'],
+            entries[0][5]['genre'])
+        self.assertEqual(entries, self.scan('lxml'))
+
+    def test_leading_comment(self):
+        # The root element has a comment and a processing instruction
+        # in front of it, which lxml treats as siblings.
+        segments = self.count('sax', 'comment.xml')
+        self.assertEqual(
+            [None, u'Commented Chapter', None],
+            [title for is_chapter, title, record in segments])
+        self.assertEqual(segments, self.count('lxml', 'comment.xml'))
+        self.assertEqual(
+            self.scan('sax', 'comment.xml'),
+            self.scan('lxml', 'comment.xml'))
+
+    def test_depends(self):
+        for name in ['book.xml', 'chapter.xml']:
+            references = self.depends('sax', name)
+            self.assertEqual(references, self.depends('lxml', name))
+            self.assertEqual(references, self.depends('fast', name))
+
+        self.assertEqual(
+            [['image', u'images/one.png'], ['include', u'chapter.xml']],
+            sorted(self.depends('sax', 'book.xml')))
+
+    def test_subjectsets(self):
+        lines = mfgames_writing.docbook.info._extract_subjectsets(
+            (_get_filename('book.xml'), 'sax'))
+        self.assertEqual(
+            [u'\tDragons', u'genre\tFantasy', u'genre\tScience Fiction'],
+            [line.split(u'\t', 1)[1] for line in lines])
+        self.assertEqual(
+            lines,
+            mfgames_writing.docbook.info._extract_subjectsets(
+                (_get_filename('book.xml'), 'lxml')))
+
+#
+# Entry
+#
+
+if __name__ == '__main__':
+    unittest.main()
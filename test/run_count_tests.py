@@ -0,0 +1,76 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#
+# Imports
+#
+
+# System Imports
+import os
+import sys
+import unittest
+
+local_directory = os.path.normpath(os.path.dirname(__file__))
+src_directory = os.path.realpath(local_directory + "/../src")
+
+sys.path.insert(0, src_directory)
+
+import mfgames_writing.docbook.count
+
+#
+# Unit Test
+#
+
+class _CountArgs(object):
+    columns = ['paragraphs', 'words', 'sentences', 'context']
+
+
+class _CountProcess(object):
+    args = _CountArgs()
+
+
+class CountTests(unittest.TestCase):
+    def run_chunks(self, chunks):
+        # Feed the chunks in as SAX would, then return the record.
+        scanner = mfgames_writing.docbook.count._CountScanner(
+            _CountProcess(),
+            'count.xml')
+        scanner.reset_count()
+
+        for chunk in chunks:
+            scanner.characters(chunk)
+
+        return scanner.finish_count()
+
+    def test_words_split_across_chunks(self):
+        record = self.run_chunks([u'One tw', u'o', u' three', u'  '])
+        self.assertEqual(3, record[1])
+
+    def test_words_match_split(self):
+        text = u' This  is\na paragraph\twith odd   spacing. '
+        record = self.run_chunks([text[i:i + 3] for i in range(0, len(text), 3)])
+        self.assertEqual(len(text.split(None)), record[1])
+
+    def test_characters(self):
+        record = self.run_chunks([u'  One\n  two  '])
+        self.assertEqual(7, record[3])
+        self.assertEqual(6, record[4])
+
+    def test_sentences(self):
+        record = self.run_chunks([u'One. "Two?" she asked! Three'])
+        self.assertEqual(4, record[2])
+
+    def test_sentences_abbreviations(self):
+        record = self.run_chunks([u'Mr. J. R. Smith left. So did I.'])
+        self.assertEqual(2, record[2])
+
+    def test_sentences_split_across_chunks(self):
+        record = self.run_chunks([u'Mr', u'. Smith left', u'.', u' Then.'])
+        self.assertEqual(2, record[2])
+
+#
+# Entry
+#
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#
+# Imports
+#
+
+# System Imports
+import StringIO
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+local_directory = os.path.normpath(os.path.dirname(__file__))
+src_directory = os.path.realpath(local_directory + "/../src")
+
+sys.path.insert(0, src_directory)
+
+import mfgames_writing.docbook.depends
+
+#
+# Unit Test
+#
+
+_HEADER = ('<?xml version="1.0" encoding="UTF-8"?>'
+    + '<chapter xmlns="http://docbook.org/ns/docbook" '
+    + 'xmlns:xinclude="http://www.w3.org/2001/XInclude" version="5.0">')
+
+
+class _CountingProcess(mfgames_writing.docbook.depends.DependsFileProcess):
+    """Counts how many times each file is parsed."""
+
+    def __init__(self):
+        super(_CountingProcess, self).__init__()
+        self.scanned = []
+
+    def scan_references(self, filename):
+        self.scanned.append(os.path.basename(filename))
+        return super(_CountingProcess, self).scan_references(filename)
+
+
+class DependsTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_filename = os.path.join(self.directory, 'cache.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, contents):
+        filename = os.path.join(self.directory, name)
+        stream = open(filename, 'wb')
+        stream.write(_HEADER + contents + '</chapter>')
+        stream.close()
+        return filename
+
+    def depends(self, names, arguments=[]):
+        # Run the process and return what it showed along with the
+        # process itself.
+        process = _CountingProcess()
+        parser = argparse.ArgumentParser()
+        process.setup_arguments(parser)
+        args = parser.parse_args(
+            arguments
+            + ['--directory-root', self.directory]
+            + [os.path.join(self.directory, name) for name in names])
+
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+        try:
+            process.process(args)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+        return output.splitlines(), process
+
+    def test_recursive_cycle(self):
+        self.write(
+            'a.xml',
+            '<xinclude:include href="b.xml"/>'
+            + '<imagedata fileref="a.png"/>')
+        self.write(
+            'b.xml',
+            '<xinclude:include href="a.xml"/>'
+            + '<imagedata fileref="b.png"/>')
+        lines, process = self.depends(['a.xml'], ['--recursive'])
+
+        self.assertEqual(['b.xml', 'a.png', 'a.xml', 'b.png'], lines)
+        self.assertEqual(['a.xml', 'b.xml'], process.scanned)
+
+    def test_ninja(self):
+        self.write('a.xml', '<imagedata fileref="a.png"/>')
+        self.write('b.xml', '<imagedata fileref="b png"/>')
+        lines, process = self.depends(
+            ['a.xml', 'b.xml'],
+            ['--format', 'ninja', '--ninja-target', '{stem}.html'])
+
+        self.assertEqual(
+            ['ninja_dyndep_version = 1',
+             'build a.html: dyndep | a.png',
+             'build b.html: dyndep | b$ png'],
+            lines)
+
+    def test_ninja_target(self):
+        self.write('a.xml', '')
+        self.write('b.xml', '')
+
+        self.assertRaises(
+            Exception,
+            self.depends,
+            ['a.xml', 'b.xml'],
+            ['--format', 'ninja', '--ninja-target', 'book.html'])
+        self.assertRaises(
+            Exception,
+            self.depends,
+            ['a.xml'],
+            ['--format', 'ninja'])
+
+    def test_write_depends(self):
+        filename = self.write('a.xml', '<imagedata fileref="a.png"/>')
+        depends_filename = filename + '.d'
+        self.depends(['a.xml'], ['--write-depends'])
+        self.assertEqual('a.png\n', open(depends_filename).read())
+
+        # An unchanged dependency file isn't written again.
+        os.utime(depends_filename, (0, 0))
+        self.depends(['a.xml'], ['--write-depends'])
+        self.assertEqual(0, os.stat(depends_filename).st_mtime)
+
+        self.write('a.xml', '<imagedata fileref="b.png"/>')
+        self.depends(['a.xml'], ['--write-depends'])
+        self.assertEqual('b.png\n', open(depends_filename).read())
+        self.assertNotEqual(0, os.stat(depends_filename).st_mtime)
+
+    def test_depends_cache(self):
+        filename = self.write('a.xml', '<imagedata fileref="a.png"/>')
+        arguments = ['--depends-cache', self.cache_filename]
+        lines, process = self.depends(['a.xml'], arguments)
+        self.assertEqual(['a.png'], lines)
+        self.assertEqual(['a.xml'], process.scanned)
+
+        # Unchanged and touched files come from the cache.
+        lines, process = self.depends(['a.xml'], arguments)
+        self.assertEqual(['a.png'], lines)
+        self.assertEqual([], process.scanned)
+
+        os.utime(filename, (0, 0))
+        lines, process = self.depends(['a.xml'], arguments)
+        self.assertEqual(['a.png'], lines)
+        self.assertEqual([], process.scanned)
+
+        # A changed file is parsed again.
+        self.write('a.xml', '<imagedata fileref="a.jpg"/>')
+        lines, process = self.depends(['a.xml'], arguments)
+        self.assertEqual(['a.jpg'], lines)
+        self.assertEqual(['a.xml'], process.scanned)
+
+#
+# Entry
+#
+
+if __name__ == '__main__':
+    unittest.main()
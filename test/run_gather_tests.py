@@ -0,0 +1,252 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#
+# Imports
+#
+
+# System Imports
+import argparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+local_directory = os.path.normpath(os.path.dirname(__file__))
+src_directory = os.path.realpath(local_directory + "/../src")
+
+sys.path.insert(0, src_directory)
+
+import mfgames_writing.docbook.gather
+import mfgames_writing.docbook.media
+
+#
+# Unit Test
+#
+
+_HEADER = ('<?xml version="1.0" encoding="UTF-8"?>'
+    + '<{0} xmlns="http://docbook.org/ns/docbook" '
+    + 'xmlns:xinclude="http://www.w3.org/2001/XInclude" version="5.0">')
+
+
+class GatherTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, contents):
+        filename = os.path.join(self.directory, name)
+
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+
+        stream = open(filename, 'wb')
+        stream.write(contents)
+        stream.close()
+        return filename
+
+    def write_docbook(self, name, element, contents):
+        return self.write(
+            name,
+            _HEADER.format(element) + contents + "</" + element + ">")
+
+    def gather(self, name, arguments=[]):
+        # Gather the file into the output directory, returning the
+        # arguments and the gathered file.
+        process = mfgames_writing.docbook.gather.GatherFileProcess()
+        parser = argparse.ArgumentParser()
+        process.setup_arguments(parser)
+        args = parser.parse_args(arguments + [
+            '--no-hash-cache',
+            os.path.join(self.directory, name),
+            os.path.join(self.directory, 'output')])
+        process.process(args)
+
+        stream = open(os.path.join(self.directory, 'output', name), 'rb')
+        contents = stream.read()
+        stream.close()
+        return args, contents
+
+    def test_repeated_include(self):
+        self.write_docbook(
+            'book.xml',
+            'book',
+            '<xinclude:include href="ch/repeat.xml"/>'
+            + '<xinclude:include href="ch/once.xml"/>'
+            + '<xinclude:include href="ch/repeat.xml"/>')
+        self.write_docbook(
+            'ch/repeat.xml',
+            'chapter',
+            '<para>Again</para><xinclude:include href="nested.xml"/>')
+        self.write_docbook('ch/nested.xml', 'section', '<para>Nested</para>')
+        self.write_docbook('ch/once.xml', 'chapter', '<para>Once</para>')
+
+        # Keep track of every file that is parsed.
+        scanner_class = mfgames_writing.docbook.gather._DocBookScanner
+        parsed = []
+
+        class _RecordingScanner(scanner_class):
+            def __init__(self, args, input_filename, *arguments):
+                parsed.append(os.path.basename(input_filename))
+                scanner_class.__init__(
+                    self,
+                    args,
+                    input_filename,
+                    *arguments)
+
+        mfgames_writing.docbook.gather._DocBookScanner = _RecordingScanner
+
+        try:
+            args, contents = self.gather('book.xml')
+        finally:
+            mfgames_writing.docbook.gather._DocBookScanner = scanner_class
+
+        self.assertEqual(
+            ['Again', 'Nested', 'Once', 'Again', 'Nested'],
+            re.findall(r'<para>(\w+)</para>', contents))
+
+        # Every file is only parsed once, and only the file that was
+        # included more than once is kept.
+        self.assertEqual(
+            ['book.xml', 'repeat.xml', 'nested.xml', 'once.xml'],
+            parsed)
+        self.assertEqual(
+            [os.path.join(self.directory, 'ch', 'repeat.xml')],
+            [key[0] for key in args.include_cache])
+
+    def test_dedup_media(self):
+        self.write('images/one.png', 'same')
+        self.write('images/two.png', 'same')
+        self.write('images/other.png', 'different')
+        self.write_docbook(
+            'article.xml',
+            'article',
+            '<imagedata fileref="images/one.png"/>'
+            + '<imagedata fileref="images/two.png"/>'
+            + '<imagedata fileref="images/other.png"/>')
+        args, contents = self.gather(
+            'article.xml',
+            ['--copy-media', '--dedup-media'])
+
+        filerefs = re.findall(r'fileref="([^"]+)"', contents)
+        self.assertEqual(filerefs[0], filerefs[1])
+        self.assertNotEqual(filerefs[0], filerefs[2])
+        self.assertEqual(
+            sorted(filerefs[1:]),
+            sorted([name for name in os.listdir(args.directory)
+                    if name.endswith('.png')]))
+
+
+class MediaTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, 'source.png')
+        self.destination = os.path.join(self.directory, 'destination.png')
+
+        stream = open(self.source, 'wb')
+        stream.write('image')
+        stream.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_copy(self):
+        media = mfgames_writing.docbook.media
+        self.assertFalse(media.is_up_to_date(self.source, self.destination))
+
+        media.place_media(self.source, self.destination, 'copy')
+        self.assertTrue(media.is_up_to_date(self.source, self.destination))
+        self.assertNotEqual(
+            os.stat(self.source).st_ino,
+            os.stat(self.destination).st_ino)
+
+    def test_changed_source(self):
+        media = mfgames_writing.docbook.media
+        media.place_media(self.source, self.destination, 'copy')
+
+        # The same size, but newer and with different contents.
+        stream = open(self.source, 'wb')
+        stream.write('IMAGE')
+        stream.close()
+        os.utime(self.source, (time.time() + 10, time.time() + 10))
+
+        self.assertFalse(media.is_up_to_date(self.source, self.destination))
+
+    def test_link(self):
+        media = mfgames_writing.docbook.media
+        media.place_media(self.source, self.destination, 'link')
+        self.assertEqual(
+            os.stat(self.source).st_ino,
+            os.stat(self.destination).st_ino)
+
+        # Copying over a link must not change the source.
+        media.place_media(self.source, self.destination, 'copy')
+        self.assertNotEqual(
+            os.stat(self.source).st_ino,
+            os.stat(self.destination).st_ino)
+
+    def test_auto(self):
+        # Reflinks may not be supported, but auto always places it.
+        media = mfgames_writing.docbook.media
+        media.place_media(self.source, self.destination, 'auto')
+        self.assertTrue(media.is_up_to_date(self.source, self.destination))
+
+
+class MediaIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.search = []
+
+        for name in ['one', 'two', 'three']:
+            directory = os.path.join(self.directory, name)
+            os.makedirs(os.path.join(directory, 'images'))
+            self.search.append(directory)
+
+        for name in ['one', 'three']:
+            stream = open(
+                os.path.join(self.directory, name, 'images', 'a.png'),
+                'wb')
+            stream.write('image')
+            stream.close()
+
+        self.index = mfgames_writing.docbook.media.MediaIndex(self.search)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def get_listed(self):
+        return sorted([
+            os.path.relpath(directory, self.directory)
+            for directory in self.index.listings])
+
+    def test_find_first(self):
+        # The search stops at the first directory with the file.
+        self.assertEqual(
+            os.path.join(self.search[0], 'images', 'a.png'),
+            self.index.find('images/a.png'))
+        self.assertEqual(['one/images'], self.get_listed())
+        self.assertEqual(None, self.index.find('images/b.png'))
+
+    def test_find_ambiguous(self):
+        self.assertEqual(
+            os.path.join(self.search[0], 'images', 'a.png'),
+            self.index.find('images/a.png', True))
+        self.assertEqual(
+            ['one/images', 'three/images', 'two/images'],
+            self.get_listed())
+        self.assertEqual(
+            [os.path.join(self.search[0], 'images', 'a.png'),
+             os.path.join(self.search[2], 'images', 'a.png')],
+            self.index.find_all('images/a.png'))
+
+#
+# Entry
+#
+
+if __name__ == '__main__':
+    unittest.main()
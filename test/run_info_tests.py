@@ -0,0 +1,302 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#
+# Imports
+#
+
+# System Imports
+import StringIO
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+local_directory = os.path.normpath(os.path.dirname(__file__))
+src_directory = os.path.realpath(local_directory + "/../src")
+
+sys.path.insert(0, src_directory)
+
+import lxml.etree
+import mfgames_writing.docbook.info
+import mfgames_writing.docbook.metadata
+
+#
+# Unit Test
+#
+
+_ARTICLE = """<?xml version="1.0" encoding="UTF-8"?>
+<article xmlns="http://docbook.org/ns/docbook" version="5.0">
+  <info>
+    <title>{0}</title>
+    <subtitle>Subtitle</subtitle>
+    <author><personname>
+      <firstname>First</firstname><surname>Last</surname>
+    </personname></author>
+  </info>
+  <para>Contents</para>
+{1}</article>
+"""
+
+
+class WhereTests(unittest.TestCase):
+    def is_match(self, wheres, metadata):
+        process = mfgames_writing.docbook.info.QueryProcess()
+        process.args = argparse.Namespace(where_clauses=[
+            mfgames_writing.docbook.info._parse_where(where)
+            for where in wheres])
+        return process.is_match(metadata)
+
+    def test_parse_exact(self):
+        name, operator, value = mfgames_writing.docbook.info._parse_where(
+            'title=Caf\xc3\xa9=Bar')
+        self.assertEqual(('title', '=', u'Café=Bar'), (name, operator, value))
+
+    def test_parse_regex(self):
+        name, operator, value = mfgames_writing.docbook.info._parse_where(
+            'subject~^Sci')
+        self.assertEqual(('subject', '~'), (name, operator))
+        self.assertTrue(value.search(u'Science Fiction'))
+
+    def test_parse_invalid(self):
+        parse = mfgames_writing.docbook.info._parse_where
+        self.assertRaises(Exception, parse, 'title')
+        self.assertRaises(Exception, parse, 'color=red')
+
+    def test_match_exact(self):
+        metadata = {'subject': [u'Fantasy', u'Science Fiction']}
+        self.assertTrue(self.is_match(['subject=Fantasy'], metadata))
+        self.assertFalse(self.is_match(['subject=Fan'], metadata))
+        self.assertFalse(self.is_match(['title=Fantasy'], metadata))
+
+    def test_match_all(self):
+        metadata = {'title': [u'One'], 'subject': [u'Fantasy']}
+        self.assertTrue(
+            self.is_match(['title~^O', 'subject=Fantasy'], metadata))
+        self.assertFalse(
+            self.is_match(['title~^O', 'subject=Horror'], metadata))
+
+
+class VirtualElementTests(unittest.TestCase):
+    def get_used(self, select, select_root="/*/d:info"):
+        args = argparse.Namespace(select_root=select_root, select=select)
+        mfgames_writing.docbook.info._compile_query(args)
+        return args.virtual_elements
+
+    def test_unused(self):
+        self.assertEqual([], self.get_used(['d:title', 'd:subtitle']))
+
+    def test_used(self):
+        self.assertEqual(
+            ['fullname', 'fulltitle'],
+            self.get_used(
+                ['d:fulltitle', 'd:author/d:personname/d:fullname']))
+        self.assertEqual(
+            ['abspath'],
+            self.get_used(['d:title'], '/*/d:info[d:abspath]'))
+
+    def test_containing_name(self):
+        # Names that only contain a virtual element don't use it.
+        self.assertEqual(
+            [],
+            self.get_used(['d:fulltitle-ish', 'd:abspaths', 'd:myfullname']))
+
+    def test_unused_not_added(self):
+        process = mfgames_writing.docbook.info.QueryProcess()
+        process.args = argparse.Namespace(
+            select_root="/*/d:info",
+            select=['d:title', 'd:fulltitle-ish'])
+        mfgames_writing.docbook.info._compile_query(process.args)
+        xml = lxml.etree.fromstring(
+            _ARTICLE.format('Title', '')).getroottree()
+        process.add_virtual_elements(xml, 'article.xml')
+
+        self.assertEqual(
+            ['title', 'subtitle', 'author'],
+            [lxml.etree.QName(child).localname
+             for child in xml.getroot()[0]])
+        self.assertEqual('Title\t', process.select_file(xml))
+
+
+class MetadataIndexTests(unittest.TestCase):
+    def setUp(self):
+        handle, self.filename = tempfile.mkstemp(suffix='.xml')
+        os.write(handle, 'one')
+        os.close(handle)
+        self.index = mfgames_writing.docbook.metadata.MetadataIndex(':memory:')
+        self.reads = []
+
+    def tearDown(self):
+        self.index.close()
+        os.remove(self.filename)
+
+    def read(self, filename):
+        self.reads.append(filename)
+        return {'title': [u'Read {0}'.format(len(self.reads))]}
+
+    def get_title(self):
+        return self.index.get_metadata(self.filename, self.read)['title']
+
+    def test_unchanged(self):
+        self.assertEqual([u'Read 1'], self.get_title())
+        self.assertEqual([u'Read 1'], self.get_title())
+        self.assertEqual(1, len(self.reads))
+
+    def test_touched(self):
+        # A new modification time with the same contents isn't read.
+        self.get_title()
+        os.utime(self.filename, (0, 0))
+        self.assertEqual([u'Read 1'], self.get_title())
+        self.assertEqual(1, len(self.reads))
+
+    def test_changed(self):
+        self.get_title()
+        stream = open(self.filename, 'a')
+        stream.write(' two')
+        stream.close()
+        self.assertEqual([u'Read 2'], self.get_title())
+
+class _QueryTestCase(unittest.TestCase):
+    """Runs queries against files in a temporary directory."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, contents):
+        filename = os.path.join(self.directory, name)
+        stream = open(filename, 'wb')
+        stream.write(contents)
+        stream.close()
+        return filename
+
+    def query(self, filenames, arguments=[]):
+        # Run the query and return the lines it wrote out.
+        process = mfgames_writing.docbook.info.QueryProcess()
+        parser = argparse.ArgumentParser()
+        process.setup_arguments(parser)
+        args = parser.parse_args(arguments + ['--'] + filenames)
+
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+        try:
+            process.process(args)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+        return output.splitlines()
+
+
+class QueryTests(_QueryTestCase):
+    def test_info_only(self):
+        # Everything after the info is never read, so the broken end
+        # of a large file doesn't matter.
+        filename = self.write(
+            'article.xml',
+            _ARTICLE.format('Title', '<para>Words</para>' * 20000)
+            + '<broken')
+        header = mfgames_writing.docbook.info._parse_header(filename)
+        self.assertEqual(
+            ['info'],
+            [lxml.etree.QName(child).localname
+             for child in header.getroot()])
+
+        arguments = ['--select', 'd:title', 'd:fulltitle',
+            'd:author/d:personname/d:fullname']
+        self.assertEqual(
+            [u'Title\tTitle: Subtitle\tLast, First'],
+            self.query([filename], ['--info-only'] + arguments))
+
+        # Without the broken end, both give the same results.
+        self.write('article.xml', _ARTICLE.format('Title', ''))
+        self.assertEqual(
+            self.query([filename], arguments),
+            self.query([filename], ['--info-only'] + arguments))
+
+    def test_info_only_without_info(self):
+        filename = self.write(
+            'article.xml',
+            '<article xmlns="http://docbook.org/ns/docbook" version="5.0">'
+            + '<title>Title</title><para>Contents</para>'
+            + '<section><title>Section</title></section></article>')
+        header = mfgames_writing.docbook.info._parse_header(filename)
+        self.assertEqual(
+            ['title'],
+            [lxml.etree.QName(child).localname
+             for child in header.getroot()])
+
+        for arguments in [[], ['--select-root', '/*']]:
+            self.assertEqual(
+                self.query([filename], arguments),
+                self.query([filename], ['--info-only'] + arguments))
+
+        self.assertEqual(
+            [u'Title'],
+            self.query([filename], ['--info-only', '--select-root', '/*']))
+
+
+class JobsTests(_QueryTestCase):
+    def test_order(self):
+        filenames = [
+            self.write('{0}.xml'.format(index),
+                _ARTICLE.format('Title {0}'.format(index), ''))
+            for index in [3, 1, 4, 0, 5, 9, 2, 6]]
+        lines = self.query(filenames, ['--jobs', '1'])
+
+        self.assertEqual(
+            ['Title 3', 'Title 1', 'Title 4', 'Title 0', 'Title 5',
+             'Title 9', 'Title 2', 'Title 6'],
+            lines)
+        self.assertEqual(lines, self.query(filenames, ['--jobs', '2']))
+
+    def test_error(self):
+        # A file that can't be parsed in a worker stops the query.
+        filenames = [
+            self.write('good.xml', _ARTICLE.format('Title', '')),
+            self.write('bad.xml', '<article>')]
+
+        self.assertRaises(
+            lxml.etree.XMLSyntaxError,
+            self.query,
+            filenames,
+            ['--jobs', '1'])
+        self.assertRaisesRegexp(
+            Exception,
+            'Cannot read .*bad.xml',
+            self.query,
+            filenames,
+            ['--jobs', '2'])
+
+    def test_subjectsets_error(self):
+        filenames = [
+            self.write('good.xml', _ARTICLE.format('Title', '')),
+            self.write('bad.xml', '<article>')]
+        extract = mfgames_writing.docbook.info._extract_worker_subjectsets
+        pool = multiprocessing.Pool(2)
+
+        try:
+            for backend in ['sax', 'lxml']:
+                self.assertRaisesRegexp(
+                    Exception,
+                    'Cannot read .*bad.xml',
+                    list,
+                    pool.imap(
+                        extract,
+                        [(filename, backend) for filename in filenames]))
+        finally:
+            pool.terminate()
+            pool.join()
+
+#
+# Entry
+#
+
+if __name__ == '__main__':
+    unittest.main()
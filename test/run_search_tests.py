@@ -0,0 +1,86 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#
+# Imports
+#
+
+# System Imports
+import os
+import sys
+import tempfile
+import unittest
+
+local_directory = os.path.normpath(os.path.dirname(__file__))
+src_directory = os.path.realpath(local_directory + "/../src")
+
+sys.path.insert(0, src_directory)
+
+import mfgames_writing.docbook.search
+
+#
+# Unit Test
+#
+
+class SearchTests(unittest.TestCase):
+    def create_index(self, paragraphs):
+        # Index the paragraphs in memory as if they came from a file.
+        index = mfgames_writing.docbook.search.SearchIndex(':memory:')
+        index.update_file(__file__, lambda filename: paragraphs)
+        return index
+
+    def test_terms(self):
+        terms = mfgames_writing.docbook.search.get_terms(u'The Café, the END.')
+        self.assertEqual([u'the', u'café', u'the', u'end'], terms)
+
+    def test_term(self):
+        index = self.create_index([
+            (u'one', 1, u'The red dragon slept.'),
+            (u'one', 2, u'The sky was red.')])
+        results = index.search([u'red'])
+        self.assertEqual([1, 2], [number for path, chapter, number in results])
+
+    def test_phrase(self):
+        index = self.create_index([
+            (u'one', 1, u'The red dragon slept.'),
+            (u'one', 2, u'A dragon, red with anger.')])
+        results = index.search([u'red dragon'])
+        self.assertEqual([(u'one', 1)], [r[1:] for r in results])
+
+    def test_all_queries(self):
+        index = self.create_index([
+            (u'one', 1, u'The red dragon slept.'),
+            (u'two', 1, u'The red dragon woke on the gold.')])
+        results = index.search([u'red dragon', u'gold'])
+        self.assertEqual([(u'two', 1)], [r[1:] for r in results])
+
+    def test_failed_read(self):
+        # A file that can't be read keeps what was indexed before.
+        handle, filename = tempfile.mkstemp(suffix='.xml')
+        os.write(handle, 'one')
+        os.close(handle)
+
+        def fail(filename):
+            raise ValueError(filename)
+
+        try:
+            index = mfgames_writing.docbook.search.SearchIndex(':memory:')
+            index.update_file(
+                filename,
+                lambda filename: [(u'one', 1, u'The red dragon.')])
+
+            stream = open(filename, 'a')
+            stream.write(' two')
+            stream.close()
+
+            self.assertRaises(ValueError, index.update_file, filename, fail)
+            self.assertEqual(1, len(index.search([u'dragon'])))
+        finally:
+            os.remove(filename)
+
+#
+# Entry
+#
+
+if __name__ == '__main__':
+    unittest.main()
@@ -19,9 +19,16 @@ def run_tests():
     # Create the test loader that includes the individual test suites.
     loader = unittest.TestLoader()
     suite = loader.loadTestsFromNames([
+        'run_count_tests',
         'run_creole_tests',
+        'run_info_tests',
+        'run_search_tests',
         'run_type_tests',
-        'run_docbook_tests'
+        'run_docbook_tests',
+        'run_backend_tests',
+        'run_gather_tests',
+        'run_wordpress_tests',
+        'run_depends_tests'
     ])
 
     # Run all the combined tests in a single instance.
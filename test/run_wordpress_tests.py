@@ -0,0 +1,372 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#
+# Imports
+#
+
+# System Imports
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+local_directory = os.path.normpath(os.path.dirname(__file__))
+src_directory = os.path.realpath(local_directory + "/../src")
+
+sys.path.insert(0, src_directory)
+
+import benchmark_wordpress
+import mfgames_writing
+import mfgames_writing.docbook.wordpress
+
+#
+# Unit Test
+#
+
+class _RecordingProcess(mfgames_writing.docbook.wordpress.UploadFilesProcess):
+    """Records when each file starts and finishes uploading instead of
+    talking to a site."""
+
+    def __init__(self, failing=None):
+        super(_RecordingProcess, self).__init__()
+        self.failing = failing
+        self.events = []
+        self.events_lock = threading.Lock()
+
+    def load_site(self):
+        pass
+
+    def upload_file(self, filename):
+        with self.events_lock:
+            self.events.append(('start', filename))
+
+        time.sleep(0.01)
+
+        if filename == self.failing:
+            raise Exception("Cannot upload " + filename)
+
+        with self.events_lock:
+            self.events.append(('end', filename))
+
+
+class UploadWaveTests(unittest.TestCase):
+    def upload(self, process, files):
+        process.args = argparse.Namespace(
+            jobs=4,
+            render_jobs=0,
+            root_directory='/site')
+        process.pending = ['/site/' + filename for filename in files]
+        process.upload_pending()
+
+    def get_depth(self, filename):
+        return filename.count('/') - 1
+
+    def test_waves(self):
+        # The files are given out of order, so the parents have to be
+        # sorted in front of their children.
+        files = [
+            'a/b/c.xml', 'a/b.xml', 'a.xml', 'd.xml', 'a/e.xml',
+            'd/f.xml', 'a/b/g.xml', 'h.xml']
+        process = _RecordingProcess()
+        self.upload(process, files)
+
+        self.assertEqual(
+            sorted(['/site/' + filename for filename in files]),
+            sorted([f for event, f in process.events if event == 'end']))
+
+        # Every file in a wave has to finish before anything in the
+        # next wave is started.
+        for index, (event, filename) in enumerate(process.events):
+            if event != 'start':
+                continue
+
+            depth = self.get_depth(filename)
+            started = [f for e, f in process.events[:index] if e == 'start']
+            ended = [f for e, f in process.events[:index] if e == 'end']
+
+            for previous in started:
+                if self.get_depth(previous) < depth:
+                    self.assertTrue(previous in ended)
+
+    def test_failure(self):
+        # A failed upload stops the deeper waves from starting.
+        process = _RecordingProcess('/site/b.xml')
+
+        self.assertRaises(
+            Exception,
+            self.upload,
+            process,
+            ['a.xml', 'b.xml', 'a/c.xml', 'b/d.xml'])
+        self.assertEqual(
+            [],
+            [f for e, f in process.events if self.get_depth(f) > 1])
+
+
+class CachePagesTests(unittest.TestCase):
+    def setUp(self):
+        logging.getLogger('benchmark').setLevel(logging.ERROR)
+        self.modified = {}
+        self.servers = []
+        self.downloaded = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def start_server(self, multicall=True):
+        # Use the stand-in server from the benchmark, but keep track
+        # of which pages are downloaded.
+        server, url = benchmark_wordpress.start_server(
+            5,
+            0,
+            multicall,
+            self.modified)
+        get_page = server.funcs['wp.getPage']
+
+        def record_page(blog, page_id, username, password):
+            self.downloaded.append(page_id)
+            return get_page(blog, page_id, username, password)
+
+        server.register_function(record_page, 'wp.getPage')
+        self.servers.append(server)
+        return url
+
+    def test_modified(self):
+        url = self.start_server()
+        count, elapsed, site = benchmark_wordpress.cache_pages(url, 2)
+        self.assertEqual(5, count)
+        self.assertEqual(['0', '1', '2', '3', '4'], self.downloaded)
+
+        # Nothing changed, so nothing is downloaded.
+        self.downloaded = []
+        count, elapsed, site = benchmark_wordpress.cache_pages(url, 2, site)
+        self.assertEqual(5, count)
+        self.assertEqual([], self.downloaded)
+
+        # Only the changed pages are downloaded again.
+        self.modified[1] = 1000
+        self.modified[3] = 2000
+        count, elapsed, site = benchmark_wordpress.cache_pages(url, 2, site)
+        self.assertEqual(5, count)
+        self.assertEqual(['1', '3'], self.downloaded)
+        self.assertEqual(
+            ['0', '1', '2', '3', '4'],
+            sorted(site['pages'].keys()))
+
+    def test_without_listing(self):
+        # Without wp.getPosts, every page is downloaded every time.
+        url = self.start_server(False)
+        count, elapsed, site = benchmark_wordpress.cache_pages(url, 2)
+        count, elapsed, site = benchmark_wordpress.cache_pages(url, 2, site)
+        self.assertEqual(5, count)
+        self.assertEqual(
+            ['0', '1', '2', '3', '4'] * 2,
+            [str(page_id) for page_id in self.downloaded])
+
+_XSLT = """<xsl:stylesheet version="1.0"
+    xmlns:xsl="http://www.w3.org/1999/XSL/Transform"
+    xmlns:d="http://docbook.org/ns/docbook">
+  <xsl:template match="/">
+    <div><p><xsl:value-of select="//d:para"/></p></div>
+  </xsl:template>
+</xsl:stylesheet>"""
+
+_PAGE = """<article xmlns="http://docbook.org/ns/docbook" version="5.0">
+  <info><title>{0}</title><date>2020-01-02</date></info>
+  <para>{1}</para>
+</article>"""
+
+
+class _JournalProcess(mfgames_writing.docbook.wordpress.UploadFilesProcess):
+    """Uses the pages it was given instead of loading them from a site
+    and records the files that would be uploaded."""
+
+    def __init__(self, root_directory, journal, pages={}):
+        super(_JournalProcess, self).__init__()
+        self.args = argparse.Namespace(
+            force=False,
+            jobs=1,
+            render_jobs=0,
+            root_directory=root_directory,
+            xslt=os.path.join(root_directory, 'page.xsl'))
+        self.log = logging.getLogger('wordpress')
+        self.journal = journal
+        self.pages = pages
+        self.site_loaded = True
+        self.uploaded = []
+
+    def send_page(self, upload, page):
+        filename, rel_filename, file_hash, post = upload
+        self.uploaded.append(rel_filename)
+        self.add_upload(rel_filename, filename, file_hash)
+
+
+class UploadJournalTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal_filename = os.path.join(self.directory, 'journal.json')
+        self.filename = self.write('page.xml', 'one')
+        self.write('page.xsl', _XSLT)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, contents):
+        filename = os.path.join(self.directory, name)
+        stream = open(filename, 'wb')
+        stream.write(contents)
+        stream.close()
+        return filename
+
+    def get_journal(self):
+        return mfgames_writing.docbook.wordpress._UploadJournal(
+            self.journal_filename,
+            'http://example.com',
+            '')
+
+    def test_journal(self):
+        journal = self.get_journal()
+        self.assertFalse(journal.is_uploaded('page', self.filename))
+
+        journal.add(
+            'page',
+            self.filename,
+            mfgames_writing.get_file_hash(self.filename))
+        journal.save()
+
+        # The journal is kept between runs.
+        journal = self.get_journal()
+        self.assertTrue(journal.is_uploaded('page', self.filename))
+        self.assertFalse(journal.is_uploaded('other', self.filename))
+
+        # A touched file is the same, but a changed one isn't.
+        os.utime(self.filename, (0, 0))
+        self.assertTrue(journal.is_uploaded('page', self.filename))
+        self.assertEqual(0, journal.entries['page'][1])
+
+        self.write('page.xml', 'two')
+        self.assertFalse(journal.is_uploaded('page', self.filename))
+
+    def test_skip_journal(self):
+        journal = self.get_journal()
+        journal.add(
+            'page',
+            self.filename,
+            mfgames_writing.get_file_hash(self.filename))
+
+        # The file is skipped before it is parsed, so it doesn't even
+        # have to be XML.
+        process = _JournalProcess(self.directory, journal)
+        process.process_file(self.filename)
+        self.assertEqual([], process.uploaded)
+
+        # Once it changed, the stale entry is ignored.
+        self.write('page.xml', _PAGE.format('Title', 'Changed'))
+        process.process_file(self.filename)
+        self.assertEqual(['page'], process.uploaded)
+        self.assertTrue(journal.is_uploaded('page', self.filename))
+
+    def test_skip_hash(self):
+        # A page on the site with the same hash is skipped before the
+        # file is parsed, and the file is added to the journal.
+        journal = self.get_journal()
+        file_hash = mfgames_writing.get_file_hash(self.filename)
+        pages = {'page': {
+            'post_id': '1',
+            'custom_fields': [
+                {'key': 'mfgames-docbook-sha256', 'value': file_hash}]}}
+        process = _JournalProcess(self.directory, journal, pages)
+
+        process.process_file(self.filename)
+        self.assertEqual([], process.uploaded)
+        self.assertTrue(journal.is_uploaded('page', self.filename))
+
+        # A page with a different hash is uploaded.
+        self.write('page.xml', _PAGE.format('Title', 'Changed'))
+        self.assertEqual(
+            (self.filename, 'page', mfgames_writing.get_file_hash(
+                self.filename), pages['page']),
+            process.get_upload(self.filename))
+
+        # Forcing the upload ignores both the journal and the hash.
+        process.args.force = True
+        process.process_file(self.filename)
+        self.assertEqual(['page'], process.uploaded)
+
+class _RenderProcess(_JournalProcess):
+    """Keeps the pages that would be sent to the site."""
+
+    def __init__(self, root_directory, jobs, render_jobs):
+        super(_RenderProcess, self).__init__(root_directory, None)
+        self.args.jobs = jobs
+        self.args.render_jobs = render_jobs
+        self.sent = {}
+
+    def send_page(self, upload, page):
+        self.sent[upload[1]] = (upload, page)
+
+
+class RenderTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.write('page.xsl', _XSLT)
+        self.filenames = [
+            self.write(
+                'page{0}.xml'.format(index),
+                _PAGE.format(
+                    'Title {0}'.format(index),
+                    'Para {0}'.format(index)))
+            for index in range(6)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, contents):
+        filename = os.path.join(self.directory, name)
+        stream = open(filename, 'wb')
+        stream.write(contents)
+        stream.close()
+        return filename
+
+    def render(self, jobs, render_jobs):
+        process = _RenderProcess(self.directory, jobs, render_jobs)
+
+        for filename in self.filenames:
+            process.process_file(filename)
+
+        if process.pending:
+            process.upload_pending()
+
+        return process.sent
+
+    def test_render_jobs(self):
+        sent = self.render(1, 0)
+        self.assertEqual(6, len(sent))
+        self.assertEqual(u'Title 3', sent['page3'][1]['title'])
+        self.assertEqual(sent, self.render(2, 2))
+        self.assertEqual(sent, self.render(1, 2))
+
+    def test_render_error(self):
+        # A file that can't be rendered is reported.
+        self.filenames.insert(2, self.write('bad.xml', '<article>'))
+
+        self.assertRaisesRegexp(
+            Exception,
+            'Cannot read .*bad.xml',
+            self.render,
+            2,
+            2)
+
+#
+# Entry
+#
+
+if __name__ == '__main__':
+    unittest.main()